@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import publish
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='benchmark the offline publish operations on a'\
+                    ' synthetic guide tree and the json codecs on real or'\
+                    ' synthetic guides.')
+
+    parser.add_argument(
+            'guides',
+            help='the guide files to benchmark the json codecs on. When none'\
+                    ' are given, the synthetic guides are used',
+            nargs='*'
+            )
+
+    cities_default = 50
+    parser.add_argument(
+            '-c',
+            '--cities',
+            help='the number of city guides in the synthetic tree. Default is'\
+                    ' {}'.format(cities_default),
+            type=int,
+            default=cities_default
+            )
+
+    pois_default = 500
+    parser.add_argument(
+            '-p',
+            '--pois',
+            help='the number of pois per city guide. Default is'\
+                    ' {}'.format(pois_default),
+            type=int,
+            default=pois_default
+            )
+
+    descriptions_default = 2
+    parser.add_argument(
+            '-d',
+            '--descriptions',
+            help='the number of descriptions per poi. Default is'\
+                    ' {}'.format(descriptions_default),
+            type=int,
+            default=descriptions_default
+            )
+
+    article_size_default = 2000
+    parser.add_argument(
+            '--article-size',
+            help='the number of characters of the description articles.'\
+                    ' Default is {}'.format(article_size_default),
+            type=int,
+            default=article_size_default
+            )
+
+    pictures_default = 100
+    parser.add_argument(
+            '--pictures',
+            help='the number of pictures in the pics.zip of every guide.'\
+                    ' Default is {}'.format(pictures_default),
+            type=int,
+            default=pictures_default
+            )
+
+    picture_size_default = 50000
+    parser.add_argument(
+            '--picture-size',
+            help='the size in bytes of the pictures. Default is'\
+                    ' {}'.format(picture_size_default),
+            type=int,
+            default=picture_size_default
+            )
+
+    parser.add_argument(
+            '-s',
+            '--stages',
+            help='the operations to benchmark. Default is all of them',
+            nargs='+',
+            choices=list(bench_stages()) + ['codecs'],
+            default=list(bench_stages()) + ['codecs']
+            )
+
+    jobs_default = 1
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            help='the number of worker processes of the operations. Default'\
+                    ' is {}'.format(jobs_default),
+            type=int,
+            default=jobs_default
+            )
+
+    parser.add_argument(
+            '--stream-pois',
+            help='stream the pois through the operations that support it',
+            action='store_true'
+            )
+
+    repeat_default = 3
+    parser.add_argument(
+            '-r',
+            '--repeat',
+            help='the number of times each measure is taken, the best one'\
+                    ' is kept. Default is {}'.format(repeat_default),
+            type=int,
+            default=repeat_default
+            )
+
+    parser.add_argument(
+            '-o',
+            '--output',
+            help='save the results as json in this file, to compare them'\
+                    ' across versions.'
+            )
+
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    template = os.path.join(tmp_dir, 'template')
+    generate_tree(template,
+                  args.cities,
+                  args.pois,
+                  descriptions=args.descriptions,
+                  article_size=args.article_size,
+                  pictures=args.pictures,
+                  picture_size=args.picture_size)
+
+    results = {
+            'publish_sha1': publish.file_hash(publish.__file__),
+            'python': platform.python_version(),
+            'json_codec': publish.json_codec[0],
+            'parameters': {k: v for k, v in vars(args).items() if k != 'output'},
+            'stages': {}
+            }
+
+    setups = bench_setups()
+    for name, stage in bench_stages().items():
+        if name in args.stages:
+            result = bench_stage(stage,
+                                 template,
+                                 os.path.join(tmp_dir, 'work'),
+                                 args.pois,
+                                 args.repeat,
+                                 jobs=args.jobs,
+                                 stream=args.stream_pois,
+                                 setup=setups.get(name))
+            results['stages'][name] = result
+            print('{:32} {:8.2f}s {:10.1f} guides/s {:12.1f} pois/s'.format(
+                name, result['seconds'], result['guides_s'],
+                result['pois_s']), file=sys.stderr)
+
+    if 'codecs' in args.stages:
+        guides = args.guides or publish.list_guide(template, 'result.json')
+        results['codecs'] = bench_codecs(guides, args.repeat)
+        for name, r in results['codecs'].items():
+            print('{:8} load {:8.1f} MB/s   dump {:8.1f} MB/s'.format(name,
+                r['load_mb_s'], r['dump_mb_s']), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    shutil.rmtree(tmp_dir)
+    return
+
+def bench_stages():
+    """
+    returns the operations that can be benchmarked. They are called with
+    the root of the guide tree, its guides, the number of jobs and whether
+    to stream the pois.
+    """
+
+    return {
+            'filter_poi': lambda path, guides, jobs, stream:
+                publish.filter_poi(guides, publish.must_remove_attraction,
+                    jobs=jobs, stream=stream),
+            'categories': lambda path, guides, jobs, stream:
+                publish.categories(guides, jobs=jobs),
+            'country_code': lambda path, guides, jobs, stream:
+                publish.country_code(guides, jobs=jobs),
+            'remove_homepage_from_domains': lambda path, guides, jobs, stream:
+                publish.remove_homepage_from_domains(guides,
+                    ['facebook', 'yelp'], jobs=jobs, stream=stream),
+            'remove_street_picture': lambda path, guides, jobs, stream:
+                publish.remove_street_picture(guides, jobs=jobs,
+                    stream=stream),
+            'remove_from_zip': lambda path, guides, jobs, stream:
+                any([publish.remove_from_zip(g, street_pictures(g))
+                     for g in guides]),
+            'list_guide': lambda path, guides, jobs, stream:
+                not publish.list_guide(path, 'result.json'),
+            'list_guide_index_cold': lambda path, guides, jobs, stream:
+                not publish.list_guide(path, 'result.json', index=True),
+            'list_guide_index': lambda path, guides, jobs, stream:
+                not publish.list_guide(path, 'result.json', index=True)
+            }
+
+def bench_setups():
+    """
+    returns what must be done, untimed, on the fresh copy of the guide tree
+    before some of the operations. They are called with the root of the
+    guide tree and its guides.
+    """
+
+    return {
+            'list_guide_index': warm_guide_index
+            }
+
+def warm_guide_index(path, guides):
+    """
+    build the guide index of the tree, once its directories are old enough
+    for the index to trust their modification time.
+    """
+
+    newest = max(os.stat(os.path.dirname(g)).st_mtime for g in guides)
+    time.sleep(max(0, newest + publish.racy_seconds - time.time()))
+    publish.list_guide(path, 'result.json', index=True)
+    return
+
+def bench_stage(stage, template, work, pois, repeat=3, jobs=1, stream=False,
+        setup=None):
+    """
+    returns the best time, and the guides and pois per second, of the stage
+    on fresh copies of the template guide tree. The setup, if any, is done
+    on each copy before the stage is timed.
+    """
+
+    times = []
+    for i in range(repeat):
+        if os.path.exists(work):
+            shutil.rmtree(work)
+        shutil.copytree(template, work)
+        guides = publish.list_guide(work, 'result.json')
+        if setup:
+            setup(work, guides)
+
+        start = time.perf_counter()
+        stage(work, guides, jobs, stream)
+        times.append(time.perf_counter() - start)
+
+    seconds = min(times)
+    return {
+            'seconds': seconds,
+            'guides_s': len(guides) / seconds,
+            'pois_s': len(guides) * pois / seconds
+            }
+
+def generate_tree(path, cities, pois, descriptions=2, article_size=2000,
+        pictures=100, picture_size=50000, seed=0):
+    """
+    generate a tree of cities guides under path in the <city>-<id>/result.json
+    layout, each with a pics.zip holding pictures of picture_size bytes, and
+    the pictures of its streets.
+    """
+
+    rand = random.Random(seed)
+    for city_id in range(1, cities + 1):
+        folder = os.path.join(path, 'city{}-{}'.format(city_id, city_id))
+        os.makedirs(folder)
+
+        content = synthetic_guide(pois,
+                                  descriptions=descriptions,
+                                  article_size=article_size,
+                                  pictures=pictures,
+                                  seed=rand.random())
+        content['Id'] = city_id
+        with open(os.path.join(folder, 'result.json'), 'w') as guide:
+            json.dump(content, guide)
+
+        with ZipFile(os.path.join(folder, 'pics.zip'), 'w', ZIP_DEFLATED) as z:
+            names = [picture_name(i) for i in range(pictures)]
+            for name in names + street_pictures(content):
+                z.writestr(name, os.urandom(picture_size))
+
+    return
+
+def picture_name(i):
+    """
+    returns the name of the i-th picture of a synthetic guide.
+    """
+
+    return 'pic-{}.jpg'.format(i)
+
+def street_picture_name(i):
+    """
+    returns the name of the picture of the street that is the i-th poi of a
+    synthetic guide.
+    """
+
+    return 'street-{}.jpg'.format(i)
+
+def street_pictures(guide):
+    """
+    returns the names of the pictures of the streets of the guide, given as
+    a file or as its content.
+    """
+
+    content = guide if isinstance(guide, dict) else publish.load_guide(guide)
+    return [p['picture']['picture'] for p in content['Cities'][0]['pois']
+            if p.get('subcategory') == 'street' and 'picture' in p]
+
+def synthetic_guide(pois, descriptions=2, article_size=2000, pictures=100,
+        seed=0):
+    """
+    returns the content of a guide with the given number of pois, each
+    with descriptions articles of about article_size characters. Every
+    poi has one of the pictures, except for the streets which have their
+    own.
+    """
+
+    rand = random.Random(seed)
+
+    def text(size):
+        return ''.join(rand.choice(string.ascii_lowercase + '  ')
+                       for i in range(size))
+
+    def word(size):
+        return ''.join(rand.choice(string.ascii_lowercase)
+                       for i in range(size))
+
+    sources = ['en.wikipedia.org', 'en.wikivoyage.org', 'wikitravel.org',
+               'www.example.com']
+    homepages = ['www.facebook.com', 'www.yelp.com', 'www.{}.com']
+    categories = {
+            'attractions': ['museum', 'monument', 'street', 'park'],
+            'restaurants': ['french', 'pizza', 'cafe'],
+            'hotels': ['hotel', 'hostel'],
+            'shopping': ['mall', 'market', 'street']
+            }
+
+    guide_pois = []
+    for i in range(pois):
+        category = rand.choice(sorted(categories))
+        poi = {
+            'name': {'name': text(20), 'lang': 'en'},
+            'category': category,
+            'subcategory': rand.choice(categories[category]),
+            'ranking': rand.randint(1, 100),
+            'location': {
+                'latitude': rand.uniform(-90, 90),
+                'longitude': rand.uniform(-180, 180)
+                },
+            'address': {'street': text(30), 'zipcode': word(6)},
+            'homepage': {'homepage': 'http://{}/{}'.format(
+                rand.choice(homepages).format(word(8)), word(10))},
+            'descriptions': {}
+            }
+
+        if pictures and poi['subcategory'] == 'street':
+            poi['picture'] = {'picture': street_picture_name(i)}
+        elif pictures:
+            poi['picture'] = {'picture': picture_name(i % pictures)}
+
+        for d in range(descriptions):
+            poi['descriptions'][word(2)] = {
+                'text': text(article_size),
+                'source': {'url': 'http://{}/wiki/{}'.format(
+                    rand.choice(sources), word(12))}
+                }
+
+        guide_pois.append(poi)
+
+    return {
+            'Id': 1,
+            'Subjects': {},
+            'Cities': [{
+                'name': word(10).capitalize(),
+                'country': 'Canada',
+                'pois': guide_pois
+                }]
+            }
+
+def bench_codecs(guides, repeat=5):
+    """
+    returns the load and dump throughput, in MB/s, of every available json
+    codec on the guide files.
+    """
+
+    data = []
+    for g in guides:
+        with open(g, 'rb') as guide:
+            data.append(guide.read())
+
+    size = sum(len(d) for d in data) / 1e6
+
+    results = {}
+    for name, (loads, dumps) in publish.json_codecs().items():
+        contents = [loads(d) for d in data]
+        load_time = best_time(lambda: [loads(d) for d in data], repeat)
+        dump_time = best_time(lambda: [dumps(c) for c in contents], repeat)
+        results[name] = {
+                'mb': size,
+                'load_mb_s': size / load_time,
+                'dump_mb_s': size / dump_time
+                }
+
+    return results
+
+def best_time(f, repeat):
+    """
+    returns the best wall clock time of repeat calls to f.
+    """
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+if __name__ == '__main__':
+    main()
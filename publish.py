@@ -1,28 +1,68 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 import argparse
+import cProfile
 import os
 import cityinfo
 import cityres
 import json
+import hashlib
 import urlinfer
 import requests
 import subprocess
 import logging
+import math
+import pstats
+import resource
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import jsonsert
 import zipclean
 import collections
+import csv
+import contextlib
 import iso3166
+import io
 import shutil
+import sqlite3
+import socket
+import struct
+import weakref
 import psycopg2
+import psycopg2.pool
 import reversegeo
 
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from functools import partial
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipFile
 from progress.bar import Bar
 from time import sleep
 from urllib.parse import urlparse
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 def main():
 
     parser = argparse.ArgumentParser(description="generate the editorial"\
@@ -209,6 +249,258 @@ def main():
             default=default_db_conf
             )
 
+    parser.add_argument(
+            '--pipeline',
+            help='run the in-memory publish operations (reversegeo,'\
+                    ' attraction-remove, remove-street-pic, homepage-remove,'\
+                    ' categories, iso3166, city-name-translation, iata) as'\
+                    ' a single pass that loads and writes every guide once',
+            action='store_true'
+            )
+
+    default_jobs = 1
+    parser.add_argument(
+            '-j',
+            '--jobs',
+            help='number of worker processes used to run the attraction-remove,'\
+                    ' remove-street-pic, reversegeo, homepage-remove,'\
+                    ' categories and iso3166 operations on the guides.'\
+                    ' Defaults to {}.'.format(default_jobs),
+            type=int,
+            default=default_jobs
+            )
+
+    default_description_batch = 50
+    parser.add_argument(
+            '--description-batch',
+            help='maximum number of description urls sent to the description'\
+                    ' content generator in one call. Defaults to'\
+                    ' {}.'.format(default_description_batch),
+            type=positive_int,
+            default=default_description_batch
+            )
+
+    default_description_concurrency = 1
+    parser.add_argument(
+            '--description-concurrency',
+            help='maximum number of description content generator calls'\
+                    ' kept in flight at once. Defaults to'\
+                    ' {}.'.format(default_description_concurrency),
+            type=positive_int,
+            default=default_description_concurrency
+            )
+
+    default_cache_dir = '/var/cache/publish'
+    parser.add_argument(
+            '--cache-dir',
+            help='directory of the cache of the generated content.'\
+                    ' Defaults to {}'.format(default_cache_dir),
+            default=default_cache_dir
+            )
+
+    parser.add_argument(
+            '--no-cache',
+            help='do not use nor update the cache of the generated content',
+            action='store_true'
+            )
+
+    default_cache_ttl = 30
+    parser.add_argument(
+            '--cache-ttl',
+            help='number of days after which cached content expires.'\
+                    ' Defaults to {}'.format(default_cache_ttl),
+            type=float,
+            default=default_cache_ttl
+            )
+
+    default_cache_size = 500000
+    parser.add_argument(
+            '--cache-size',
+            help='maximum number of entries kept in each cache.'\
+                    ' Defaults to {}'.format(default_cache_size),
+            type=int,
+            default=default_cache_size
+            )
+
+    parser.add_argument(
+            '--invalidate-resolution',
+            help='ids of the guides for which the cached dbpedia resolution'\
+                    ' must be discarded before publishing',
+            nargs='+',
+            type=int,
+            default=[]
+            )
+
+    default_download_workers = 8
+    parser.add_argument(
+            '--download-workers',
+            help='number of banners downloaded at once. Defaults to'\
+                    ' {}'.format(default_download_workers),
+            type=positive_int,
+            default=default_download_workers
+            )
+
+    default_download_timeout = 60
+    parser.add_argument(
+            '--download-timeout',
+            help='seconds after which a stalled banner download is'\
+                    ' abandoned. Defaults to {}'.format(default_download_timeout),
+            type=float,
+            default=default_download_timeout
+            )
+
+    parser.add_argument(
+            '--stream-banner',
+            help='insert the downloaded banners directly into pics.zip'\
+                    ' instead of going through a file and the zip binary',
+            action='store_true'
+            )
+
+    default_db_chunk_size = 200
+    parser.add_argument(
+            '--db-chunk-size',
+            help='maximum number of guides looked up in a single database'\
+                    ' query. The iata operation holds that many guides in'\
+                    ' memory at once. Defaults to {}'.format(default_db_chunk_size),
+            type=positive_int,
+            default=default_db_chunk_size
+            )
+
+    default_geocode_precision = 4
+    parser.add_argument(
+            '--geocode-precision',
+            help='number of decimals the poi coordinates are rounded to when'\
+                    ' looking up the reverse geocoding cache. Defaults to'\
+                    ' {}'.format(default_geocode_precision),
+            type=int,
+            default=default_geocode_precision
+            )
+
+    parser.add_argument(
+            '--offline-geocoder',
+            help='csv address dataset with latitude and longitude columns.'\
+                    ' When given, reversegeo looks the pois up in it instead'\
+                    ' of using the online reverse geocoder',
+            default=None
+            )
+
+    parser.add_argument(
+            '-I',
+            '--incremental',
+            help='only run the publish operations on the guides that changed,'\
+                    ' or whose operation parameters changed, since the last'\
+                    ' run. The state is kept in {} under path'.format(
+                        manifest_name),
+            action='store_true'
+            )
+
+    parser.add_argument(
+            '--resume',
+            help='resume the last run where it stopped, if it did not'\
+                    ' complete. The guides completed by each operation are'\
+                    ' recorded in {} under path'.format(journal_name),
+            action='store_true'
+            )
+
+    json_codec_default = 'auto'
+    parser.add_argument(
+            '--json-codec',
+            help='the json codec used to load and dump the guides. auto'\
+                    ' picks the fastest installed one. Default is'\
+                    ' {}'.format(json_codec_default),
+            choices=['auto', 'orjson', 'ujson', 'json'],
+            default=json_codec_default
+            )
+
+    parser.add_argument(
+            '--stream-pois',
+            help='stream the pois of the guides through the attraction-remove,'\
+                    ' remove-street-pic and homepage-remove operations instead'\
+                    ' of loading the whole guides in memory. Requires ijson.'\
+                    ' Not used in pipeline mode',
+            action='store_true'
+            )
+
+    parser.add_argument(
+            '--guide-index',
+            help='keep an index of the guides in {} under path so that only'\
+                    ' the directories modified since the last run are'\
+                    ' scanned'.format(guide_index_name),
+            action='store_true'
+            )
+
+    scan_workers_default = 1
+    parser.add_argument(
+            '--scan-workers',
+            help='the number of threads scanning the guide directories.'\
+                    ' Default is {}'.format(scan_workers_default),
+            type=int,
+            default=scan_workers_default
+            )
+
+    parser.add_argument(
+            '--metrics-file',
+            help='write the timing metrics of the publication into this'\
+                    ' file, in the prometheus text format. Point it into'\
+                    ' the textfile collector directory of the node exporter'\
+                    ' with a .prom extension'
+            )
+
+    metrics_interval_default = 60
+    parser.add_argument(
+            '--metrics-interval',
+            help='the number of seconds between the writes of the metrics'\
+                    ' file during the publication. Default is'\
+                    ' {}'.format(metrics_interval_default),
+            type=int,
+            default=metrics_interval_default
+            )
+
+    parser.add_argument(
+            '--profile',
+            help='profile every publish operation with cProfile into a'\
+                    ' .pstats file of this directory and print a summary'\
+                    ' at the end. Use -j 1 to profile the guide'\
+                    ' transformations, worker processes are not profiled',
+            metavar='DIR'
+            )
+
+    parser.add_argument(
+            '--profile-memory',
+            help='with --profile, also trace the memory allocations of every'\
+                    ' publish operation with tracemalloc and write their top'\
+                    ' allocation sites next to the .pstats files',
+            action='store_true'
+            )
+
+    nailgun_servers_default = 1
+    parser.add_argument(
+            '--nailgun-servers',
+            help='the number of nailgun servers started on consecutive ports'\
+                    ' for the description, banner and editorial operations.'\
+                    ' The calls go to the least busy one. Default is'\
+                    ' {}'.format(nailgun_servers_default),
+            type=positive_int,
+            default=nailgun_servers_default
+            )
+
+    parser.add_argument(
+            '--nailgun-port',
+            help='the port of the first nailgun server. Default is'\
+                    ' NAILGUN_PORT from the environment, or 2113',
+            type=int
+            )
+
+    editorial_concurrency_default = 1
+    parser.add_argument(
+            '--editorial-concurrency',
+            help='the number of guides whose editorial content is generated'\
+                    ' at the same time. Should be about --nailgun-servers.'\
+                    ' Default is {}'.format(editorial_concurrency_default),
+            type=positive_int,
+            default=editorial_concurrency_default
+            )
+
     args = parser.parse_args()
 
     if args.test:
@@ -217,7 +509,10 @@ def main():
         exit(0)
 
     if args.dump:
-        guides = list_guide(args.path,args.guide_name)
+        guides = list_guide(args.path,
+                            args.guide_name,
+                            index=args.guide_index,
+                            workers=args.scan_workers)
         for name in guides:
             print(name)
         exit(0)
@@ -228,6 +523,27 @@ def main():
 
     config_logger(args.log_file, args.message_debug)
 
+    if set_json_codec(args.json_codec):
+        die('the {} json codec is not installed'.format(args.json_codec))
+
+    if args.stream_pois and not ijson:
+        die('ijson must be installed to stream the pois of the guides')
+
+    # a bad dataset must stop the publication before its first stage.
+    if args.offline_geocoder and 'reversegeo' in args.publish_functions:
+        try:
+            process_geocoder(args.offline_geocoder)
+        except (OSError, ValueError) as e:
+            die('could not load the offline geocoder data: {}'.format(e))
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    if cache_dir and not writable_cache_dir(cache_dir):
+        logging.warning('the cache directory {} is not writable, nothing'\
+                ' will be cached'.format(cache_dir))
+        sys.stderr.write('warning: the cache directory {} is not writable,'\
+                ' nothing will be cached\n'.format(cache_dir))
+        cache_dir = None
+
     publish(args.path,
             args.guide_name,
             args.endpoint,
@@ -242,7 +558,33 @@ def main():
             args.homepage_domains,
             args.mbroker_username,
             args.mbroker_password,
-            args.configdb)
+            args.configdb,
+            pipeline=args.pipeline,
+            jobs=args.jobs,
+            description_batch=args.description_batch,
+            description_concurrency=args.description_concurrency,
+            cache_dir=cache_dir,
+            cache_ttl=args.cache_ttl,
+            cache_size=args.cache_size,
+            invalidate_resolution=args.invalidate_resolution,
+            download_workers=args.download_workers,
+            download_timeout=args.download_timeout,
+            stream_banner=args.stream_banner,
+            db_chunk_size=args.db_chunk_size,
+            geocode_precision=args.geocode_precision,
+            geocoder_data=args.offline_geocoder,
+            incremental=args.incremental,
+            resume=args.resume,
+            stream_pois=args.stream_pois,
+            guide_index=args.guide_index,
+            scan_workers=args.scan_workers,
+            metrics_file=args.metrics_file,
+            metrics_interval=args.metrics_interval,
+            profile_dir=args.profile,
+            profile_memory=args.profile_memory,
+            nailgun_servers=args.nailgun_servers,
+            nailgun_port=args.nailgun_port,
+            editorial_concurrency=args.editorial_concurrency)
 
     return
 
@@ -264,6 +606,35 @@ def config_logger(filename, debug):
 
     return
 
+def positive_int(value):
+    """
+    argparse type of the options that must be a positive integer, like the
+    batch sizes.
+
+    EXAMPLE
+    =======
+
+    >>> positive_int('50')
+    50
+
+    >>> positive_int('0')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: 0 is not a positive integer
+
+    """
+
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+                '{} is not a positive integer'.format(value))
+
+    return number
+
 def publish(path,
             guide_name,
             endpoint,
@@ -278,90 +649,549 @@ def publish(path,
             homepage_domains,
             mbroker_username,
             mbroker_password,
-            dbconf):
+            dbconf,
+            pipeline=False,
+            jobs=1,
+            description_batch=50,
+            description_concurrency=1,
+            cache_dir=None,
+            cache_ttl=30,
+            cache_size=500000,
+            invalidate_resolution=(),
+            download_workers=8,
+            download_timeout=60,
+            stream_banner=False,
+            db_chunk_size=200,
+            geocode_precision=4,
+            geocoder_data=None,
+            incremental=False,
+            resume=False,
+            stream_pois=False,
+            guide_index=False,
+            scan_workers=1,
+            metrics_file=None,
+            metrics_interval=60,
+            profile_dir=None,
+            profile_memory=False,
+            nailgun_servers=1,
+            nailgun_port=None,
+            editorial_concurrency=1):
     """
     Runs the publishing operation on the given directory path.
     """
 
-    guides = list_guide(path,guide_name)
+    guides = list_guide(path, guide_name, index=guide_index, workers=scan_workers)
     error = False
 
+    # the parameters that change the outcome of a stage, part of its
+    # fingerprint in incremental mode.
+    stage_params = {
+            'description': [function_description_class, description_gen],
+            'banner': [endpoint, function_description_class, description_gen],
+            'editorial': [endpoint, function_class, content_generator],
+            'homepage-remove': sorted(homepage_domains),
+            'reversegeo': [geocoder_data, geocode_precision],
+            'city-name-translation': [dbconf],
+            'iata': [dbconf]
+            }
+
+    global journal
+    journal = Journal(os.path.join(path, journal_name), resume)
+
+    metrics_writer = None
+    if metrics_file:
+        metrics_writer = MetricsWriter(metrics_file, metrics_interval)
+        metrics_writer.start()
+
+    manifest = load_manifest(path) if incremental else None
+    hashes = {}
+    ran = []
+
+    def rehash(stage_guides):
+        """
+        update the content hashes of the guides after a stage.
+        """
+
+        for g in stage_guides:
+            hashes[g] = file_hash(g)
+
+    if manifest is not None:
+        rehash(guides)
+
+    profiler = None
+    if profile_dir:
+        profiler = Profiler(profile_dir, memory=profile_memory)
+
+    def profile(stage):
+        """
+        returns a context manager profiling stage, if asked to.
+        """
+
+        if profiler:
+            return profiler.stage(stage)
+
+        return contextlib.nullcontext()
+
+    def run(stages, function):
+        """
+        run function on the guides for which one of stages is not up to
+        date and record the outcome for the manifest.
+        """
+
+        stage_guides = guides
+        if manifest is not None:
+            stage_guides = outdated_guides(manifest, path, guides, hashes,
+                    stages, stage_params)
+            logging.info('{} of {} guides are outdated for {}'.format(
+                len(stage_guides), len(guides), stages))
+
+        if resume:
+            stage_guides = [g for g in stage_guides
+                            if not journal.is_completed(stages, g)]
+            logging.info('{} guides left to complete for {}'.format(
+                len(stage_guides), stages))
+
+        if not stage_guides:
+            return False
+
+        journal.stages = stages
+        stage = metrics.stage = ','.join(stages)
+        start = time.time()
+        with profile(stage):
+            stage_error = function(stage_guides)
+        elapsed = time.time() - start
+        journal.sync()
+
+        # the stages that follow must see what this one changed.
+        if manifest is not None:
+            rehash(stage_guides)
+
+        logging.info('{} done in {:.1f}s'.format(stage, elapsed))
+        metrics.observe('publish_stage_duration_seconds', elapsed,
+                        stage=stage)
+        metrics.inc('publish_stage_guides_total', len(stage_guides),
+                    stage=stage)
+        if stage_error:
+            metrics.inc('publish_stage_errors_total', stage=stage)
+
+        ran.append((stages, stage_guides, stage_error))
+        return stage_error
+
+    # the jvm stages share a single nailgun server with all their jars.
+    jars = []
+    if {'description', 'banner'} & set(publish_functions):
+        jars.append(description_gen)
+    if 'editorial' in publish_functions:
+        jars.append(content_generator)
+    if jars:
+        nailguninit(nailgun_bin,
+                    *jars,
+                    servers=nailgun_servers,
+                    port=nailgun_port)
+
     if 'description' in publish_functions:
         logging.info('starting description content generation')
-        error |= description_publish(guides,
-                                     user_agent,
-                                     function_description_class,
-                                     nailgun_bin,
-                                     description_gen)
-
+        description_cache = None
+        if cache_dir:
+            description_cache = open_cache(cache_dir,
+                                           'descriptions.sqlite',
+                                           cache_ttl,
+                                           cache_size)
+        error |= run(['description'],
+                     lambda gs: description_publish(gs,
+                         user_agent,
+                         function_description_class,
+                         nailgun_bin,
+                         description_gen,
+                         batch_size=description_batch,
+                         concurrency=description_concurrency,
+                         cache=description_cache))
+        if description_cache:
+            logging.info('description cache: {}'.format(
+                description_cache.stats()))
+            description_cache.close()
+
+    geocode_options = {
+            'cache_dir': cache_dir,
+            'cache_ttl': cache_ttl,
+            'cache_size': cache_size,
+            'precision': geocode_precision,
+            'geocoder_data': geocoder_data
+            }
+
+    # load the offline geocoder once, before any worker is started.
+    if geocoder_data and 'reversegeo' in publish_functions:
+        process_geocoder(geocoder_data)
+
+    # the dbpedia resolution of the cities is shared by banner and editorial.
+    resolution_cache = None
+    resolution_functions = {'banner', 'editorial'} & set(publish_functions)
+    if cache_dir and (resolution_functions or invalidate_resolution):
+        resolution_cache = open_cache(cache_dir,
+                                      'resolution.sqlite',
+                                      cache_ttl,
+                                      cache_size)
+        for city_id in invalidate_resolution:
+            invalidate_guide(resolution_cache, city_id)
+
+    # in pipeline mode each run of consecutive in-memory stages is done in a
+    # single pass, at the place of its first stage.
+    segments = {}
+    if pipeline:
+        segments = {s[0]: s for s in pipeline_segments(publish_functions)}
+        fused = [f for s in segments.values() for f in s]
+        publish_functions = [f for f in publish_functions if not f in fused]
+
+    def run_pipeline(stage):
+        """
+        run the pipeline that starts with stage, if there is one.
+        """
+
+        stages = segments.get(stage)
+        if not stages:
+            return False
+
+        logging.info('starting single pass pipeline of {}'.format(stages))
+        return run(stages,
+                   lambda gs: pipeline_publish(gs,
+                       stages,
+                       homepage_domains,
+                       dbconf,
+                       jobs=jobs,
+                       chunk_size=db_chunk_size,
+                       geocode_options=geocode_options))
+
+    error |= run_pipeline('reversegeo')
     if 'reversegeo' in publish_functions:
         logging.info('starting reverse geocoding of places')
-        error |= add_parse_address(guides)
+        error |= run(['reversegeo'],
+                     lambda gs: add_parse_address(gs,
+                         jobs=jobs,
+                         geocode_options=geocode_options))
 
+    error |= run_pipeline('attraction-remove')
     if 'attraction-remove' in publish_functions:
         logging.info('starting attraction remove')
-        error |= filter_poi(guides, must_remove_attraction)
+        error |= run(['attraction-remove'],
+                     lambda gs: filter_poi(gs,
+                         must_remove_attraction,
+                         jobs=jobs,
+                         stream=stream_pois))
 
+    error |= run_pipeline('remove-street-pic')
     if 'remove-street-pic' in publish_functions:
         logging.info('starting removal of street pic remove')
-        error |= remove_street_picture(guides)
+        error |= run(['remove-street-pic'],
+                     lambda gs: remove_street_picture(gs,
+                         jobs=jobs,
+                         stream=stream_pois))
 
     if 'banner' in publish_functions:
         logging.info('starting banner fetching for the guides')
-        error |= banner(guides,
-                        endpoint,
-                        function_description_class,
-                        user_agent,
-                        nailgun_bin,
-                        description_gen)
-
+        error |= run(['banner'],
+                     lambda gs: banner(gs,
+                         endpoint,
+                         function_description_class,
+                         user_agent,
+                         nailgun_bin,
+                         description_gen,
+                         cache=resolution_cache,
+                         workers=download_workers,
+                         timeout=download_timeout,
+                         stream=stream_banner))
+
+    # zipcode-remove and guesslang work on the whole path, they always run.
     if 'zipcode-remove' in publish_functions:
         logging.info('starting zipcode cleanup')
-        error |= zipclean.zipclean(path, guide_name)
+        with metrics.time('publish_stage_duration_seconds',
+                          stage='zipcode-remove'), profile('zipcode-remove'):
+            error |= zipclean.zipclean(path, guide_name)
+        if manifest is not None:
+            rehash(guides)
 
+    error |= run_pipeline('homepage-remove')
     if 'homepage-remove' in publish_functions:
         logging.info('starting homepage cleanup')
-        error |= remove_homepage_from_domains(guides, homepage_domains)
+        error |= run(['homepage-remove'],
+                     lambda gs: remove_homepage_from_domains(gs,
+                         homepage_domains,
+                         jobs=jobs,
+                         stream=stream_pois))
 
+    error |= run_pipeline('categories')
     if 'categories' in publish_functions:
         logging.info('starting guide categories cleanup')
-        error |= categories(guides)
+        error |= run(['categories'], lambda gs: categories(gs, jobs=jobs))
 
+    error |= run_pipeline('iso3166')
     if 'iso3166' in publish_functions:
         logging.info('starting iso3166 alpha2 appending')
-        error |= country_code(guides)
+        error |= run(['iso3166'], lambda gs: country_code(gs, jobs=jobs))
 
     if 'guesslang' in publish_functions:
         logging.info('starting language guessing for poi name')
-        error |= guesslang(path, mbroker_username, mbroker_password)
+        with metrics.time('publish_stage_duration_seconds',
+                          stage='guesslang'), profile('guesslang'):
+            error |= guesslang(path, mbroker_username, mbroker_password)
+        if manifest is not None:
+            rehash(guides)
 
+    error |= run_pipeline('city-name-translation')
     if 'city-name-translation' in publish_functions:
         logging.info('starting alternate city name translation')
-        error |= city_name_translation(dbconf,guides)
+        error |= run(['city-name-translation'],
+                     lambda gs: city_name_translation(dbconf, gs, db_chunk_size))
 
+    error |= run_pipeline('iata')
     if 'iata' in publish_functions:
         logging.info('starting iata code fetching')
-        error |= iata_codes(dbconf, guides)
+        error |= run(['iata'],
+                     lambda gs: iata_codes(dbconf, gs, db_chunk_size))
 
     if 'editorial' in publish_functions:
         logging.info('starting editorial content generation')
-        error |= editorial_publish(guides,
-                                   endpoint,
-                                   function_class,
-                                   user_agent,
-                                   nailgun_bin,
-                                   content_generator)
+        error |= run(['editorial'],
+                     lambda gs: editorial_publish(gs,
+                         endpoint,
+                         function_class,
+                         user_agent,
+                         nailgun_bin,
+                         content_generator,
+                         cache=resolution_cache,
+                         concurrency=editorial_concurrency))
+
+    if resolution_cache:
+        logging.info('resolution cache: {}'.format(resolution_cache.stats()))
+        resolution_cache.close()
+
+    if manifest is not None:
+        update_manifest(manifest, path, guides, hashes, ran, stage_params)
+        save_manifest(path, manifest)
+
+    # the run went through, there is nothing left to resume.
+    journal.close(remove=True)
+    journal = None
+
     if error:
         print('the software encountered errors during guide publication.'\
                 ' please see the log file ({0}) for more details'.format(
                     log_file))
 
+    log_db_timings()
+    log_counters()
+    metrics.log_slowest()
+    if metrics_writer:
+        metrics_writer.stop()
+
+    if profiler:
+        profiler.log_summary()
     logging.info('publish operation finished')
     nailgunstop()
     return
 
 
 
+manifest_name = '.publish-manifest.json'
+
+def load_manifest(path):
+    """
+    returns the incremental publishing manifest of the guides under path.
+    It maps the path of each guide, relative to path, to the fingerprint of
+    every stage that is up to date for it.
+    """
+
+    manifest = {}
+    try:
+        with open(os.path.join(path, manifest_name), 'r') as m:
+            manifest = json.load(m)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        logging.error('the manifest under {} is corrupted. All the guides'\
+                ' will be published'.format(path))
+
+    return manifest
+
+def save_manifest(path, manifest):
+    """
+    atomically write the incremental publishing manifest under path.
+    """
+
+    filename = os.path.join(path, manifest_name)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as m:
+        json.dump(manifest, m)
+
+    os.replace(tmp_filename, filename)
+    return
+
+def outdated_guides(manifest, path, guides, hashes, stages, stage_params):
+    """
+    returns the guides for which at least one of stages was not run on
+    their current content with the current parameters.
+    """
+
+    outdated = []
+    for g in guides:
+        entry = manifest.get(os.path.relpath(g, path), {})
+        for stage in stages:
+            fingerprint = stage_fingerprint(hashes[g],
+                                            stage_params.get(stage, []))
+            if entry.get(stage) != fingerprint:
+                outdated.append(g)
+                break
+
+    return outdated
+
+def update_manifest(manifest, path, guides, hashes, ran, stage_params):
+    """
+    update the manifest with the stages that ran, fingerprinted on the
+    final content hashes of the guides. The stages that reported an error
+    are considered outdated for all the guides they ran on. The stages that
+    did not run keep their fingerprint: it no longer matches if the guide
+    was changed since, so they run again next time.
+    """
+
+    for stages, stage_guides, stage_error in ran:
+        for g in stage_guides:
+            entry = manifest.setdefault(os.path.relpath(g, path), {})
+            for stage in stages:
+                if stage_error:
+                    entry.pop(stage, None)
+                else:
+                    entry[stage] = stage_fingerprint(hashes[g],
+                            stage_params.get(stage, []))
+
+    # forget about the guides that are gone.
+    names = {os.path.relpath(g, path) for g in guides}
+    for name in list(manifest):
+        if not name in names:
+            del manifest[name]
+
+    return
+
+def file_hash(filename):
+    """
+    returns the sha1 hex digest of the content of filename.
+    """
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+def stage_fingerprint(content_hash, params):
+    """
+    returns the fingerprint of a stage run with params on a guide whose
+    content hashes to content_hash.
+
+    EXAMPLE
+    =======
+
+    >>> stage_fingerprint('abc', ['facebook']) == stage_fingerprint('abc', ['facebook'])
+    True
+
+    >>> stage_fingerprint('abc', ['facebook']) == stage_fingerprint('abc', ['yelp'])
+    False
+
+    """
+
+    key = json.dumps([content_hash, params], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+journal_name = '.publish-journal'
+
+# the journal of the current run, if any.
+journal = None
+
+def checkpoint(guides):
+    """
+    record in the journal of the run that the current stage is completed
+    for the guides.
+    """
+
+    if journal:
+        journal.record(guides)
+
+    return
+
+def open_cache(cache_dir, filename, ttl, size):
+    """
+    open the cache stored under filename in cache_dir. ttl is given in days.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return Cache(os.path.join(cache_dir, filename),
+                 ttl=ttl * 24 * 3600 if ttl else None,
+                 max_entries=size)
+
+def writable_cache_dir(cache_dir):
+    """
+    returns True if the caches can be stored in cache_dir, creating it if
+    needed.
+    """
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return False
+
+    return os.access(cache_dir, os.W_OK | os.X_OK)
+
+# the caches opened by the stages running in this process.
+process_caches = {}
+
+def process_cache(cache_dir, filename, ttl, size):
+    """
+    returns the cache stored under filename in cache_dir, opening it only
+    once per process.
+    """
+
+    key = (cache_dir, filename)
+    if not key in process_caches:
+        process_caches[key] = open_cache(cache_dir, filename, ttl, size)
+
+    return process_caches[key]
+
+# counters of the events of the stages. Worker processes hand theirs back
+# to the parent along with their results.
+counters = collections.Counter()
+
+# the offline geocoders loaded in this process, by dataset filename. They
+# are only read so forked workers can keep using the parent's.
+process_geocoders = {}
+
+def process_geocoder(filename):
+    """
+    returns the offline geocoder of the dataset filename, loading it only
+    once per process.
+    """
+
+    if not filename in process_geocoders:
+        process_geocoders[filename] = OfflineGeocoder(filename)
+
+    return process_geocoders[filename]
+
+def log_counters():
+    """
+    log the value of the counters, and the hit rate of the reverse
+    geocoding cache.
+    """
+
+    for name, value in sorted(counters.items()):
+        logging.info('{}: {}'.format(name, value))
+
+    hits = counters['reversegeo cache hits']
+    lookups = hits + counters['reversegeo cache misses']
+    if lookups:
+        logging.info('reversegeo cache hit rate: {:.1f}%'.format(
+            100.0 * hits / lookups))
+
+    return
+
 def guesslang(path,username, password):
     """
     Lang guess script on every file.
@@ -393,177 +1223,330 @@ def guide_id(guide_path):
 
     return city_id
 
-def iata_codes(conf, guides):
-
-    # read the database configuration.
-    db_conf = None
-    with open(conf,'r') as db:
-        db_conf = json.load(db)
-
-    if not db_conf:
-        logging.error('could not load the database configuration for iata_codes')
-        return True
-
-    host = None
-    user = None
-    password = None
-    dbname = None
-    try:
-        alt_name = db_conf.get('iata-codes',None)
-        host = alt_name.get('host',None)
-        user = alt_name.get('user',None)
-        password = alt_name.get('password',None)
-        dbname = alt_name.get('dbname',None)
-    except:
-        logging.error('could not retrieve complete information from the db conf file')
-        return True
-
-    # prepare the database connection.
-    connection = None
-    try:
-        connection = psycopg2.connect(
-                host=host,
-                user=user,
-                password=password,
-                dbname=dbname)
-    except:
-        logging.error('could not establish connection to the db. Is the provided info in the db credential file correct?')
-        return True
-
-    query_template = "select * from iata(%s,%s,%s,%s)"
-
-    for guide in guides:
-
-        content = guide_content(guide)
-        (top, left, bottom, right) = content['Cities'][0]['bounding_box']
+db_configs = {}
+db_pools = {}
+# the statements prepared on each connection, forgotten with it.
+db_prepared = weakref.WeakKeyDictionary()
+db_timings = collections.OrderedDict()
 
-        cur = connection.cursor()
-        cur.execute(query_template, (top,right, bottom, left))
+def db_config(conf):
+    """
+    returns the content of the json database configuration file conf. The
+    file is only read once.
+    """
 
-        code =  cur.fetchone()
+    if not conf in db_configs:
+        with open(conf,'r') as db:
+            db_configs[conf] = json.load(db)
 
+    return db_configs[conf]
 
+def close_process_connections():
+    """
+    close the database pools and the caches opened by this process. They
+    are opened again when needed. This must be done before forking worker
+    processes: a connection inherited by a worker would be finalized there,
+    which terminates it for the parent as well.
+    """
 
-        try:
-            content['Cities'][0]['iata'] = code[0]
-        except:
-            content['Cities'][0]['iata'] = None
+    for pool in db_pools.values():
+        if pool:
+            pool.closeall()
+    db_pools.clear()
+    db_prepared.clear()
 
-        # dump the new content in the file
-        with open(guide,'w') as g:
-            json.dump(content, g)
+    for cache in process_caches.values():
+        if cache:
+            cache.close()
+    process_caches.clear()
 
-    return False
+    return
 
+def db_pool(conf, section, maxconn=4):
+    """
+    returns the pool of connections to the database described by section
+    in the json configuration file conf. The pool is created once per
+    process and holds up to maxconn connections. Returns None if the
+    database could not be reached.
+    """
 
-def city_name_translation(conf, guides):
+    key = (conf, section)
+    if key in db_pools:
+        return db_pools[key]
 
     # read the database configuration.
-    db_conf = None
-    with open(conf,'r') as db:
-        db_conf = json.load(db)
+    db_conf = db_config(conf)
 
     if not db_conf:
-        logging.error('could not load the database configuration for city-name-translation')
-        return True
+        logging.error('could not load the database configuration for {}'.format(section))
+        db_pools[key] = None
+        return None
 
     host = None
     user = None
     password = None
     dbname = None
     try:
-        alt_name = db_conf.get('alternate-names',None)
-        host = alt_name.get('host',None)
-        user = alt_name.get('user',None)
-        password = alt_name.get('password',None)
-        dbname = alt_name.get('dbname',None)
+        section_conf = db_conf.get(section,None)
+        host = section_conf.get('host',None)
+        user = section_conf.get('user',None)
+        password = section_conf.get('password',None)
+        dbname = section_conf.get('dbname',None)
     except:
         logging.error('could not retrieve complete information from the db conf file')
-        return True
+        db_pools[key] = None
+        return None
 
-    # prepare the database connection.
-    connection = None
+    # prepare the database connections.
+    pool = None
     try:
-        connection = psycopg2.connect(
+        pool = psycopg2.pool.ThreadedConnectionPool(
+                1,
+                maxconn,
                 host=host,
                 user=user,
                 password=password,
                 dbname=dbname)
     except:
         logging.error('could not establish connection to the db. Is the provided info in the db credential file correct?')
-        return True
 
-    query_template = "select isolanguage, alternate_name from projects_alternate_names where projectid = %s"
+    db_pools[key] = pool
+    return pool
 
-    for guide in guides:
-        # extract the guide id from the guide name
+@contextlib.contextmanager
+def db_cursor(conf, section):
+    """
+    context manager giving a cursor on a connection taken from the pool of
+    section, or None if the database could not be reached. The connection
+    goes back to the pool afterward.
+    """
 
-        content = guide_content(guide)
+    pool = db_pool(conf, section)
+    if not pool:
+        yield None
+        return
 
-        city_id = guide_id(guide)
+    connection = pool.getconn()
+    try:
+        # we only read, there is no need to hold a transaction open.
+        connection.autocommit = True
+        with connection.cursor() as cur:
+            yield cur
+    finally:
+        pool.putconn(connection)
+
+def db_execute(cur, name, statement, params):
+    """
+    execute the statement with params on cur. It is prepared on the server
+    under name the first time it is used on a connection and only executed
+    afterward. The number of executions and their time are counted per name
+    in db_timings.
+    """
 
-        #make the query
-        cur = connection.cursor()
-        cur.execute(query_template, (city_id,))
+    prepared = db_prepared.setdefault(cur.connection, set())
+    if not name in prepared:
+        cur.execute('prepare {} as {}'.format(name, statement))
+        prepared.add(name)
 
-        # build the alternate names
-        alternates = [ {"isolanguage": r[0], "alternate-name": r[1]} for r in  cur]
+    start = time.time()
+    placeholders = ', '.join(['%s'] * len(params))
+    cur.execute('execute {} ({})'.format(name, placeholders), params)
 
-        # insert alternate-names into the guide
+    elapsed = time.time() - start
+    timing = db_timings.setdefault(name, [0, 0.0])
+    timing[0] += 1
+    timing[1] += elapsed
+    metrics.observe('publish_external_call_duration_seconds', elapsed,
+                    call='db ' + name)
 
-        content['Cities'][0]['alternate-names'] = alternates
+    return
 
-        # dump the new content in the file
-        with open(guide,'w') as g:
-            json.dump(content, g)
+def merge_db_timings(timings):
+    """
+    add the db statement timings gathered by a worker process to the ones of
+    this process.
+    """
 
-    return False
+    for name, (count, total) in timings.items():
+        timing = db_timings.setdefault(name, [0, 0.0])
+        timing[0] += count
+        timing[1] += total
+
+    return
 
-def filter_poi(guides, f):
+def log_db_timings():
     """
-    Remove certain POIS based on a filter function. Filter function should
-    return True if the poi should be REMOVED.
+    log the number of executions and the time spent in each db statement.
     """
-    nbr_guides = len(guides)
 
-    bar = Bar('filtering the guides poi with a function.',max=nbr_guides)
-    Error = False
+    for name, (count, total) in db_timings.items():
+        logging.info('db statement {}: {} executions in {:.2f}s'\
+                ' ({:.1f}ms on average)'.format(name, count, total,
+                    1000.0 * total / count))
 
-    bar.start()
+    return
 
-    for g in guides:
-        cur_content = None
-        with open(g,'r') as file_guide:
-            cur_content = json.load(
-                    file_guide,
-                    object_pairs_hook=collections.OrderedDict)
+def iata_codes(conf, guides, chunk_size=200):
+    """
+    Adds the iata code of the closest airport to all the city guides. The
+    codes of chunk_size guides are fetched with a single query.
+    """
 
-        if not cur_content:
-            logging.error('could not load content for:{}. POI not filtered'.format(g))
+    if not db_pool(conf, 'iata-codes'):
+        return True
 
-        else:
+    return guide_stage(guides,
+                       'adding iata codes to city guides',
+                       [batch_transform(iata_content, conf=conf)],
+                       chunk_size=chunk_size)
 
-            # get the POI.
-            guide_pois = None
-            try:
-                guide_pois = cur_content['Cities'][0]['pois']
-            except:
-                logging.error('{} did not contain any POI. They will not be filtered'.format(g))
-                bar.next()
-                continue
+def iata_content(items, conf):
+    """
+    set the iata code of the cities found in the contents of the (guide,
+    content) items, with a single query for all of them.
+    """
+
+    results = [(False, False)] * len(items)
 
-            new_pois = [p for p in guide_pois if not f(p)]
-            cur_content['Cities'][0]['pois'] = new_pois
+    # the bounding box of every guide, along with its position in items.
+    boxes = []
+    for i, (guide, content) in enumerate(items):
+        try:
+            (top, left, bottom, right) = content['Cities'][0]['bounding_box']
+            boxes.append((i, top, right, bottom, left))
+        except Exception as e:
+            logging.error('could not get the bounding box of {}. It will'\
+                    ' not contain an iata code'.format(guide))
+            results[i] = (False, True)
 
-            # reserialize the guide content.
-            with open(g,'w') as file_guide:
-                json.dump(cur_content, file_guide)
+    if not boxes:
+        return results
 
-        bar.next()
+    query_template = "select b.i, c.* from"\
+            " unnest($1::int[], $2::numeric[], $3::numeric[], $4::numeric[],"\
+            " $5::numeric[]) as b(i, t, r, bo, l)"\
+            " left join lateral"\
+            " (select * from iata(b.t, b.r, b.bo, b.l) limit 1) as c on true"
 
+    codes = {}
+    with db_cursor(conf, 'iata-codes') as cur:
+        if cur is None:
+            return [(False, True)] * len(items)
 
-    bar.finish()
-    return Error
+        db_execute(cur,
+                   'iata_codes',
+                   query_template,
+                   [list(column) for column in zip(*boxes)])
+
+        for row in cur:
+            codes[row[0]] = row[1] if len(row) > 1 else None
+
+    for i, top, right, bottom, left in boxes:
+        content = items[i][1]
+        changed = assoc(content['Cities'][0], 'iata', codes.get(i))
+        results[i] = (changed, False)
+
+    return results
+
+def city_name_translation(conf, guides, chunk_size=200):
+    """
+    Adds the alternate names of the city to all the city guides.
+    """
+
+    names = alternate_names(conf, guides, chunk_size)
+    if names is None:
+        return True
+
+    return guide_stage(guides,
+                       'adding alternate city names to city guides',
+                       [partial(alternate_names_content, names=names)])
+
+def alternate_names(conf, guides, chunk_size=200):
+    """
+    fetch the alternate names of the cities of all the guides, chunk_size
+    cities per query. Returns a dictionary of the alternate names of each
+    guide id, None if the database could not be reached.
+    """
+
+    query_template = "select projectid, isolanguage, alternate_name from projects_alternate_names where projectid = ANY($1::int[])"
+
+    # extract the guide ids from the guide names
+    city_ids = [guide_id(g) for g in guides]
+    city_ids = list(collections.OrderedDict.fromkeys(
+        i for i in city_ids if i is not None))
+
+    names = collections.defaultdict(list)
+    with db_cursor(conf, 'alternate-names') as cur:
+        if cur is None:
+            return None
+
+        for ids in chunks(city_ids, chunk_size):
+            db_execute(cur, 'alternate_names', query_template, [ids])
+
+            # build the alternate names
+            for r in cur:
+                names[r[0]].append({"isolanguage": r[1], "alternate-name": r[2]})
+
+    return dict(names)
+
+def alternate_names_content(guide, content, names):
+    """
+    set the alternate names of the city found in the guide content, taken
+    from the names fetched by alternate_names.
+    """
+
+    if names is None:
+        return False, True
+
+    alternates = names.get(guide_id(guide), [])
+
+    # insert alternate-names into the guide
+    return assoc(content['Cities'][0], 'alternate-names', alternates), False
+
+def filter_poi(guides, f, jobs=1, stream=False):
+    """
+    Remove certain POIS based on a filter function. Filter function should
+    return True if the poi should be REMOVED.
+    """
+
+    if stream:
+        return guide_stage(guides,
+                           'filtering the guides poi with a function.',
+                           [stream_transform(filter_poi_stream, f=f)],
+                           jobs=jobs,
+                           stream=True)
+
+    return guide_stage(guides,
+                       'filtering the guides poi with a function.',
+                       [partial(filter_poi_content, f=f)],
+                       jobs=jobs)
+
+def filter_poi_content(guide, content, f):
+    """
+    Remove from the guide content the POIS for which f returns True.
+    """
+
+    # get the POI.
+    guide_pois = None
+    try:
+        guide_pois = content['Cities'][0]['pois']
+    except:
+        logging.error('{} did not contain any POI. They will not be filtered'.format(guide))
+        return False, False
+
+    new_pois = [p for p in guide_pois if not f(p)]
+    content['Cities'][0]['pois'] = new_pois
+
+    changed = len(new_pois) != len(guide_pois)
+    return changed, False
+
+def filter_poi_stream(guide, poi, state, f):
+    """
+    Remove the poi streamed from the guide if f returns True for it.
+    """
+
+    removed = bool(f(poi))
+    return not removed, removed, False
 
 def must_remove_attraction(poi):
     """
@@ -609,174 +1592,203 @@ def descriptions_url(descriptions):
             continue
     return urls
 
-def country_code(guides):
+def country_code(guides, jobs=1):
     """
     Adds the country code to all the city guides.
     """
-    nbr_guides = len(guides)
-    error = False
 
-    # prepare the progress bar.
-    bar = Bar('adding country codes to city guides', max=nbr_guides)
+    return guide_stage(guides,
+                       'adding country codes to city guides',
+                       [country_code_content],
+                       jobs=jobs)
 
-    for g in guides:
-        cur_content = None
-        with open(g,'r') as file_guide:
-            cur_content = json.load(file_guide,object_pairs_hook=collections.OrderedDict)
-
-        if not cur_content:
-            logging.error('could not load content for:{}.This guide will.'\
-                    'not contain an ISO3166 alpha2 country code'.format(g))
-            bar.next()
-            error = True
-            continue
+def country_code_content(guide, content):
+    """
+    set the ISO3166 alpha2 country code of the city found in the guide
+    content.
+    """
 
-        # compute the iso 3166 alpha2 of the country code based on the country
-        # attribute of the guide.
-        country = None
+    # compute the iso 3166 alpha2 of the country code based on the country
+    # attribute of the guide.
+    country = None
+    try:
+        country = content['Cities'][0]['country']
+    except:
+        logging.error('Could not retrieve country name for:{}. This guide'\
+                ' will not contain an ISO3166 alpha2' \
+                ' country code'.format(guide))
+        return False, True
+
+    # handle the special cases here
+    if country == 'Congo, The Democratic Republic Of The':
+        alpha2 = 'CD'
+    else:
         try:
-            country = cur_content['Cities'][0]['country']
+            alpha2 = iso3166.countries[country].alpha2
         except:
-            logging.error('Could not retrieve country name for:{}. This guide'\
-                    ' will not contain an ISO3166 alpha2' \
-                    ' country code'.format(g))
-            bar.next()
-            error = True
-            continue
-
-        # handle the special cases here
-        if country == 'Congo, The Democratic Republic Of The':
-            alpha2 = 'CD'
-        else:
-            try:
-                alpha2 = iso3166.countries[country].alpha2
-            except:
-                logging.error('The country name {} could'\
-                        ' not be mapped to an iso3166 alpha2 country code.'\
-                        ' guide {} will not contain a'\
-                        ' country code.'.format(country,g))
-                bar.next()
-                error = True
-                continue
+            logging.error('The country name {} could'\
+                    ' not be mapped to an iso3166 alpha2 country code.'\
+                    ' guide {} will not contain a'\
+                    ' country code.'.format(country,guide))
+            return False, True
 
-        # insert the alpha2 code into the guide.
-        cur_content['Cities'][0]['alpha2'] = alpha2
-
-        # reserialize the guide content.
-        with open(g,'w') as file_guide:
-            json.dump(cur_content, file_guide)
-
-        bar.next()
-
-    return error
+    # insert the alpha2 code into the guide.
+    return assoc(content['Cities'][0], 'alpha2', alpha2), False
 
-def categories(guides):
+def categories(guides, jobs=1):
     """
     collect categories/subcategories from the guides and serialize them
     on top.
     """
 
-    error = False
-    for guide in guides:
-        cur_guide_content = None
-        subjects = dict()
-
-        with open(guide,'r') as fileguide:
-            cur_guide_content = json.load(fileguide, object_pairs_hook=collections.OrderedDict)
-            cur_guide_content = dict(cur_guide_content)
-
-        if not cur_guide_content:
-            logging.error('no content found in {}'.format(guide))
-            continue
-
-        try:
-            guide_pois = cur_guide_content['Cities'][0]['pois']
-        except Exception as e:
-            logging.error('could not get a hold on the pois for {}. Guide will not be considered'.format(guide))
-            error = True
-            continue
-
-        for poi in guide_pois:
-            category = poi.get("category", None)
-            if category:
-                # just add the category to the subjects if not already in.
-                if not category in subjects:
-                    subjects[category] = set()
+    return guide_stage(guides,
+                       'collecting the categories of the guides',
+                       [categories_content],
+                       jobs=jobs)
 
-                subcategory = poi.get("subcategory", None)
-                if subcategory:
-                    subjects[category].add(subcategory)
+def categories_content(guide, content):
+    """
+    collect categories/subcategories from the guide content and set them
+    as the guide subjects.
+    """
 
-            else:
-                continue
+    try:
+        guide_pois = content['Cities'][0]['pois']
+    except Exception as e:
+        logging.error('could not get a hold on the pois for {}. Guide will not be considered'.format(guide))
+        return False, True
+
+    # subcategories are kept in the order they are first seen so that the
+    # subjects are stable from one run to the other.
+    subjects = collections.OrderedDict()
+    for poi in guide_pois:
+        category = poi.get("category", None)
+        if category:
+            # just add the category to the subjects if not already in.
+            if not category in subjects:
+                subjects[category] = []
+
+            subcategory = poi.get("subcategory", None)
+            if subcategory and not subcategory in subjects[category]:
+                subjects[category].append(subcategory)
 
-        guide_subject = cur_guide_content.get('Subjects', None)
-        if guide_subject == None:
-            error = True
-            logging.error('could not get a hold of the guide subject for {}. Categories rectification ignored for this guide'.format(guide))
-            continue
         else:
-            new_subjects = dict()
-            for k,v in subjects.items():
-                new_subjects[k] = list(v)
-
-
-            # Assign the current guide subjects.
-            cur_guide_content['Subjects'] = new_subjects
+            continue
 
-            # reserialize the guide.
-            with open(guide,'w') as fileguide:
-                json.dump(cur_guide_content, fileguide)
+    guide_subject = content.get('Subjects', None)
+    if guide_subject == None:
+        logging.error('could not get a hold of the guide subject for {}. Categories rectification ignored for this guide'.format(guide))
+        return False, True
 
-    return error
+    # Assign the current guide subjects.
+    return assoc(content, 'Subjects', subjects), False
 
 def banner(guides,
            endpoint,
            function_description_class,
            user_agent,
            nailgun_bin,
-           description_gen):
+           description_gen,
+           cache=None,
+           workers=8,
+           timeout=60,
+           stream=False):
     """
     Insert a banner picture into a guide and download it on the file system.
+    The city resolution is taken from the cache when one is given. The
+    banners are downloaded by a pool of workers sharing their connections.
+    With stream, the banners go straight into pics.zip without being
+    written on the file system first.
     """
 
     nailguninit(nailgun_bin, description_gen)
 
     error = False
-    pbar = Bar('fetching the depiction banner for the guides',max=len(guides)+1)
+    pbar = Bar('fetching the depiction banner for the guides',max=len(guides))
     pbar.start()
 
-    for i, g in enumerate(guides):
-        url = depiction_url(g, user_agent, function_description_class,
-                endpoint)
-        if url:
-            guide_folder = os.path.dirname(g)
-            filename = url_filename(url)
-            error = download(guide_folder, filename, url)
-            error |= zip_insert(guide_folder, filename)
-            error |= remove_banner(guide_folder, filename)
-            if error:
-                logging.error('could not download/insert/remove {0}. There '\
-                        'will be no banner for {1}'.format(url, g))
-                insert_error = jsonsert.imagesert(g, None, None)
+    urls = []
+    for g in guides:
+        start = time.time()
+        urls.append(depiction_url(g, user_agent, function_description_class,
+                endpoint, cache))
+        metrics.guides([g], time.time() - start)
+        pbar.next()
 
-            else:
-                logging.info('inerting details into the guide {0}'.format(g))
-                insert_error = jsonsert.imagesert(g, filename, url)
+    pbar.finish()
 
-        else:
-            logging.error('could not find a depiction image for {0} so there will be no banner'.format(g))
-            insert_error = jsonsert.imagesert(g, None, None)
-            error = True
+    session = http_session(user_agent, workers)
+    pbar = Bar('downloading the banners of the guides', max=len(guides))
+    pbar.start()
 
-        if insert_error:
-            logging.error("problem inserting the image into {0}".format(g))
-            error = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        downloads = {}
+        for g, url in zip(guides, urls):
+            if url:
+                future = executor.submit(download_to_zip if stream else download,
+                                         session,
+                                         os.path.dirname(g),
+                                         url_filename(url),
+                                         url,
+                                         timeout)
+                downloads[future] = (g, url)
 
-        pbar.next()
+            else:
+                logging.error('could not find a depiction image for {0} so there will be no banner'.format(g))
+                if jsonsert.imagesert(g, None, None):
+                    logging.error("problem inserting the image into {0}".format(g))
+                error = True
+                pbar.next()
 
+        for future in as_completed(downloads):
+            g, url = downloads[future]
+            try:
+                download_error = future.result()
+            except Exception as e:
+                logging.error('could not download {0} for {1}: {2}'.format(
+                    url, g, e))
+                download_error = True
+
+            insert_error = banner_insert(g, url, download_error, in_zip=stream)
+            if not insert_error:
+                checkpoint([g])
+            error |= insert_error
+            pbar.next()
 
     pbar.finish()
+    session.close()
+    return error
+
+def banner_insert(g, url, download_error, in_zip=False):
+    """
+    insert the banner downloaded from url into the pics.zip of the guide g
+    and its details into the guide. in_zip tells that the banner was
+    downloaded directly into pics.zip. When the banner could not be
+    downloaded, the guide is left without a banner.
+    """
+
+    guide_folder = os.path.dirname(g)
+    filename = url_filename(url)
+
+    error = download_error
+    if not in_zip:
+        if not error:
+            error |= zip_insert(guide_folder, filename)
+        error |= remove_banner(guide_folder, filename)
+
+    if error:
+        logging.error('could not download/insert/remove {0}. There '\
+                'will be no banner for {1}'.format(url, g))
+        insert_error = jsonsert.imagesert(g, None, None)
+
+    else:
+        logging.info('inerting details into the guide {0}'.format(g))
+        insert_error = jsonsert.imagesert(g, filename, url)
+
+    if insert_error:
+        logging.error("problem inserting the image into {0}".format(g))
+        error = True
+
     return error
 
 def remove_banner(guide_folder, filename):
@@ -794,22 +1806,22 @@ def remove_banner(guide_folder, filename):
     error = status != 0
     return error
 
-def depiction_url(guide_filename, user_agent, classpath, endpoint):
+def depiction_url(guide_filename, user_agent, classpath, endpoint,
+        cache=None):
     """
     Uses the description generator to retrieve the depiction url of the
-    guide.
+    guide. The resolution of the city is memoized in cache, if any.
     """
 
-    content = None
-    with open(guide_filename,'r') as guide_file:
-        content = json.load(guide_file, object_pairs_hook = collections.OrderedDict)
+    content = load_guide(guide_filename)
     if not content:
         logging.error("could not load json guide from {0}."\
                 " No depiction url can be found".format(guide_filename))
         return None
 
     search = cityinfo.cityinfo(content)
-    uri = cityres.cityres(search, endpoint)
+    uri = memoize(cache, guide_filename, 'uri:' + search_key(search),
+            cityres.cityres, search, endpoint)
 
     if not uri:
         logging.error("could not find a dbpedia resource for {0}."\
@@ -818,7 +1830,8 @@ def depiction_url(guide_filename, user_agent, classpath, endpoint):
 
     unquoted_uri = unquote(uri)
     # infer the english wikivoyage from the uri.
-    wiki_urls = urlinfer.urlinferwiki([unquoted_uri])
+    wiki_urls = memoize(cache, guide_filename, 'wiki:' + unquoted_uri,
+            urlinfer.urlinferwiki, [unquoted_uri])
 
     wikivoyage = "wikivoyage"
     wikipedia = "wikipedia"
@@ -830,11 +1843,17 @@ def depiction_url(guide_filename, user_agent, classpath, endpoint):
     depiction_url = None
 
     if len(wikivoyage_urls) > 0:
-        depiction_url = depiction_source(wikivoyage_urls[0],
+        depiction_url = memoize(cache, guide_filename,
+                'depiction:' + wikivoyage_urls[0],
+                depiction_source,
+                wikivoyage_urls[0],
                 classpath,
                 user_agent)
     if len(wikipedia_urls) > 0 and not depiction_url:
-        depiction_url = depiction_source(wikipedia_urls[0],
+        depiction_url = memoize(cache, guide_filename,
+                'depiction:' + wikipedia_urls[0],
+                depiction_source,
+                wikipedia_urls[0],
                 classpath,
                 user_agent)
 
@@ -848,12 +1867,8 @@ def depiction_source(src, classpath, user_agent):
     returns a depiction url from the src. Will return None if not found."
     """
 
-    depiction_template = "ng-nailgun {0} -u '{1}' -d '{2}' &> /dev/null"
-    depiction_instance = depiction_template.format(classpath, user_agent ,src)
+    result = nailgun(classpath, ['-u', user_agent, '-d', unquote(src)])
 
-    result = subprocess.check_output(depiction_instance,
-                                     shell=True,
-                                     universal_newlines=True)
     if result == 'nil\n':
         logging.error("wikison returned nil for {0}".format(src))
         return None
@@ -861,20 +1876,99 @@ def depiction_source(src, classpath, user_agent):
     result = unquote(result.strip())
     return result
 
-def download(folder, filename, url):
+def http_session(user_agent, workers):
+    """
+    returns a requests session that identifies itself with user_agent and
+    keeps up to workers connections alive per host.
+    """
+
+    session = requests.Session()
+    session.headers['User-Agent'] = user_agent
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def download(session, folder, filename, url, timeout=60):
     """
-    Uses wget to fetch the url content and saves it to folder under filename.
-    inserts it into the pics.zip file
+    fetch the url content with session and streams it to folder under
+    filename.
     """
 
+    if not filename:
+        logging.error('could not find a filename in {0} to download it'\
+                ' into {1}'.format(url, folder))
+        return True
+
     absolute_filename = os.path.join(folder, filename)
 
-    wget_template = "wget -O {0} {1}"
-    wget_instance = wget_template.format(absolute_filename, url)
+    start = time.time()
+    size = 0
+    try:
+        with external_call('download'), \
+                session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(absolute_filename, 'wb') as banner_file:
+                for chunk in response.iter_content(chunk_size=64*1024):
+                    banner_file.write(chunk)
+                    size += len(chunk)
+    except (requests.RequestException, OSError) as e:
+        logging.error('could not download {0}: {1}'.format(url, e))
+        return True
 
-    status = subprocess.call(wget_instance, shell = True)
-    error = status != 0
-    return error
+    logging.info('downloaded {0} ({1} bytes in {2:.2f}s)'.format(
+        url, size, time.time() - start))
+    return False
+
+def download_to_zip(session, folder, filename, url, timeout=60,
+        zipname='pics.zip'):
+    """
+    fetch the url content with session and insert it as filename into the
+    pics.zip file of folder, without writing it on the file system. Creates
+    the pics.zip file if it does not exist. A banner already in the archive
+    is not downloaded again.
+    """
+
+    absolute_zipname = os.path.join(folder, zipname)
+
+    if not filename:
+        logging.error('could not find a filename in {0} to insert it into'\
+                ' {1}'.format(url, absolute_zipname))
+        return True
+
+    start = time.time()
+    try:
+        if os.path.exists(absolute_zipname):
+            with ZipFile(absolute_zipname, 'r') as z:
+                if filename in z.namelist():
+                    logging.info('{0} is already in {1}'.format(filename,
+                        absolute_zipname))
+                    return False
+
+        # the whole banner is received before the archive is opened so that
+        # a failed download never leaves a truncated entry in it.
+        content = io.BytesIO()
+        with external_call('download'), \
+                session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64*1024):
+                content.write(chunk)
+
+        with external_call('zip append'), \
+                ZipFile(absolute_zipname, 'a', ZIP_DEFLATED) as z:
+            z.writestr(filename, content.getvalue())
+
+    except (requests.RequestException, OSError, BadZipFile) as e:
+        logging.error('could not download {0} into {1}: {2}'.format(url,
+            absolute_zipname, e))
+        return True
+
+    logging.info('downloaded {0} into {1} ({2} bytes in {3:.2f}s)'.format(
+        url, absolute_zipname, content.tell(), time.time() - start))
+    return False
 
 def zip_insert(folder, filename, zipname='pics.zip'):
     """
@@ -927,375 +2021,872 @@ def description_publish(guides,
                         user_agent,
                         function_class,
                         nailgun_bin,
-                        description_gen):
+                        description_gen,
+                        batch_size=50,
+                        concurrency=1,
+                        cache=None):
     """
-    Publish the description content for the guides.
+    Publish the description content for the guides. The description urls
+    of a guide are sent to the generator batch_size at a time and up to
+    concurrency of these calls are kept in flight, across guides. A guide
+    is written once all of its descriptions have been generated.
+
+    When a cache is given, the content already generated for a url is
+    taken from it instead of the generator.
     """
     # start the nailgun thing for usage with decription_generation.
     nailguninit(nailgun_bin, description_gen)
-    sources_domain = {'wikipedia','wikivoyage'}
     error = False
-    for g in guides:
-        jsonguide = None
-        with open(g,'r') as guide:
-            jsonguide = json.load(guide)
 
-        if not jsonguide:
-            logging.error('could not load json from {0}'.format(g))
-            error = True
-            continue
+    pbar = Bar('extracting description for the poi(s) of the guides',max=len(guides))
+    pbar.start()
 
-        # notice the 0 index here. This is ok because there is only one city
-        # per guide. Maybe that will not be the case in the future.
-        pois = jsonguide['Cities'][0]['pois']
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for g in guides:
+            start = time.time()
+            jsonguide = load_guide(g)
 
-        pbar = Bar('extracting description for the poi(s) in {0}:'.format(g),max=len(pois)+1)
-        pbar.start()
-        for i,p in enumerate(pois):
-            desc = p['descriptions']
-            for k, v in desc.items():
-                try:
-                    url = v['source'].get('url')
-                except:
-                    logging.error("source did not contain a dictionary"\
-                            " for {0}".format(p['name']['name']))
-                    continue
-                hostname = urlparse(url).hostname
-                if hostname:
-                    tldn = hostname.split('.')[-2]
-                else:
-                    continue
-                if tldn in sources_domain:
-                    content_raw = description_content(
-                            [url],
-                            function_class,
-                            user_agent)
-                    c_list = json.loads(content_raw)
-                    content = c_list[0] if len(c_list) > 0 else None
-                    if not content:
-                        poi_name = p['name']['name']
-                        logging.error(
-                                'failed to generate descriptive content'\
-                                ' for {0} using url {1}'.format(poi_name,
-                                    url))
-                        error = True
-                    else:
-                        v['text'] = content.get('article',None)
-                        v['source']['url'] = content.get('url',None)
+            if not jsonguide:
+                logging.error('could not load json from {0}'.format(g))
+                error = True
+                pbar.next()
+                continue
 
+            # notice the 0 index here. This is ok because there is only one
+            # city per guide. Maybe that will not be the case in the future.
+            pois = jsonguide['Cities'][0]['pois']
+            sources = description_sources(pois)
+
+            # the same article may be the source of more than one description.
+            urls = list(collections.OrderedDict.fromkeys(u for p, v, u in sources))
+
+            contents = {}
+            if cache:
+                for u in urls:
+                    content = cache.get(u)
+                    if content:
+                        contents[u] = content
+                urls = [u for u in urls if not u in contents]
+
+            batches = [executor.submit(description_batch,
+                                       batch,
+                                       function_class,
+                                       user_agent)
+                       for batch in chunks(urls, batch_size)]
+            pending.append((g, jsonguide, sources, contents, batches, cache,
+                            start))
+
+            # only keep a bounded number of guides in memory while their
+            # content is being generated.
+            while len(pending) > concurrency:
+                error |= description_write(*pending.popleft())
+                pbar.next()
+
+        while pending:
+            error |= description_write(*pending.popleft())
             pbar.next()
 
-        # redump the guide into the file
-        pbar.finish()
-        with open(g,'w') as guide:
-            json.dump(jsonguide, guide)
-
+    pbar.finish()
     logging.info('description content succesfully inserted in all guides')
     return error
 
-def description_content(urls,class_path, user_agent):
+def description_write(g, jsonguide, sources, contents, batches, cache,
+        start):
     """
-    generate the description content from a url.
+    wait for the description batches of the guide g, insert their content
+    along with the already known contents into jsonguide and redump it into
+    the file. The generated content is added to the cache, if any. The
+    guide was loaded at start.
     """
-    quoted_urls = quote_urls(urls)
-    urls_args = " ".join(quoted_urls)
-    ed_gen_template = 'ng-nailgun {0} -u "{1}" -m {2} &> /dev/null'
-    ed_gen_instance = ed_gen_template.format(class_path, user_agent, urls_args)
 
-    content = subprocess.check_output(ed_gen_instance, shell=True,
-            universal_newlines=True)
+    error = False
+    for batch in batches:
+        try:
+            generated = batch.result()
+        except Exception as e:
+            logging.error('could not generate descriptions for {}: {}'.format(
+                g, e))
+            error = True
+            continue
 
-    return content
+        contents.update(generated)
 
+        if cache:
+            for u, content in generated.items():
+                cache.put(u, {'article': content.get('article', None),
+                              'url': content.get('url', None)})
 
-def guide_content(guide):
-    """
-    return the content of a guide.
-    """
+    error |= insert_descriptions(sources, contents)
 
-    content = None
-    with open(guide,'r') as file_guide:
-        content = json.load(file_guide,
-                object_pairs_hook = collections.OrderedDict)
+    # redump the guide into the file
+    dump_guide(jsonguide, g)
 
-    if not content:
-        logging.error('problem while loading the content for {}'.format(guide))
-        return None
-    else:
-        return content
+    if not error:
+        checkpoint([g])
 
-def add_parse_address(guides):
+    metrics.guides([g], time.time() - start)
+    return error
+
+def description_sources(pois):
     """
-    Uses reverse geocoding to try and add a parsed version of the address.
+    returns the (poi, description, url) of the descriptions of the pois
+    that have a wikipedia or wikivoyage source url.
     """
-    Error = False
-    bar = Bar('adding parsed address',max=len(guides))
-    bar.start()
 
-    for guide in guides:
-        content = guide_content(guide)
-        if not content:
-            continue
-        else:
-            # get the pois
-            pois = None
+    sources_domain = {'wikipedia','wikivoyage'}
+    sources = []
+    for p in pois:
+        desc = p['descriptions']
+        for k, v in desc.items():
             try:
-                pois = content['Cities'][0]['pois']
-            except Exception as e:
-                logging.error('guide {} did not contain pois. Street picture'\
-                        ' will not be removed.'.format(guide))
-                bar.next()
+                url = v['source'].get('url')
+            except:
+                logging.error("source did not contain a dictionary"\
+                        " for {0}".format(p['name']['name']))
                 continue
+            hostname = urlparse(url).hostname
+            if hostname:
+                tldn = hostname.split('.')[-2]
+            else:
+                continue
+            if tldn in sources_domain:
+                sources.append((p, v, url))
 
-            for p in pois:
-                latitude = get_in(p, "location", "latitude")
-                longitude = get_in(p, "location", "longitude")
+    return sources
 
-                try:
-                    coords = ", ".join([str(latitude),str(longitude)])
-                    parsed = reversegeo.reverse_geocode(coords)
-                    p['address']['parsed'] = parsed
-                except:
-                    Error=True
-                    logging.error('could not add parsed address to a poi ...')
+def description_batch(urls, function_class, user_agent):
+    """
+    generate the description content of all the urls with a single call to
+    the generator. Returns a dictionary of the content found for each url.
+    """
 
-            # reserialize the content.
-            with open(guide, 'w') as file_guide:
-                json.dump(content,file_guide)
+    content_raw = description_content(urls, function_class, user_agent)
+    c_list = json.loads(content_raw)
 
+    # the generator answers with one entry per url, in order. Should it not,
+    # fall back on the source url of each entry. It may have been
+    # canonicalized so the urls that cannot be matched are missed.
+    if len(c_list) == len(urls):
+        return {u: c for u, c in zip(urls, c_list) if c}
 
-        bar.next()
+    wanted = set(urls)
+    return {c.get('url'): c for c in c_list if c and c.get('url') in wanted}
 
-    bar.finish()
-    return Error
+def insert_descriptions(sources, contents):
+    """
+    set the text and url of the description of each (poi, description, url)
+    source with the content generated for its url. Returns True if content
+    is missing for any of them.
+    """
 
+    error = False
+    for p, v, url in sources:
+        content = contents.get(url)
+        if not content:
+            poi_name = p['name']['name']
+            logging.error(
+                    'failed to generate descriptive content'\
+                    ' for {0} using url {1}'.format(poi_name,
+                        url))
+            error = True
+        else:
+            v['text'] = content.get('article',None)
+            v['source']['url'] = content.get('url',None)
 
+    return error
 
-def remove_street_picture(guides):
+def description_content(urls,class_path, user_agent):
     """
-    Remove pictures from the poi when the subcategory is street.
+    generate the description content from a url.
     """
 
-    removed_pic_name = []
-    Error = False
-    bar = Bar('removing street pics',max=len(guides))
-    bar.start()
-    for guide in guides:
-        content = guide_content(guide)
-        if not content:
-            continue
-        else:
-            # get the pois
-            pois = None
-            try:
-                pois = content['Cities'][0]['pois']
-            except Exception as e:
-                logging.error('guide {} did not contain pois. Street picture'\
-                        ' will not be removed.'.format(guide))
-                bar.next()
-                continue
+    args = ['-u', user_agent, '-m'] + [unquote(u) for u in urls]
+    content = nailgun(class_path, args)
 
-            for p in pois:
-                sub = p.get('subcategory')
-                if sub == 'street':
-                    try:
-                        pic = p['picture']['picture']
-                        removed_pic_name.append(pic)
-                        p.pop('picture')
-                    except Exception as e:
-                        continue
+    return content
 
-            # reserialize the content.
-            with open(guide, 'w') as file_guide:
-                json.dump(content,file_guide)
 
-            #remove_from_zip(guide, removed_pic_name)
+def json_codecs():
+    """
+    returns the available codecs for the guides, fastest first. A codec is
+    a (loads, dumps) pair working on utf-8 encoded bytes. They all keep the
+    keys of the objects in the order of the document, and dump the non ascii
+    characters escaped like the json module does since the guides are read
+    downstream with the locale encoding.
+    """
+
+    codecs = collections.OrderedDict()
+    if orjson:
+        codecs['orjson'] = (orjson.loads, orjson_dumps)
 
-        bar.next()
+    if ujson:
+        codecs['ujson'] = (ujson.loads,
+                           lambda obj: ujson.dumps(obj,
+                               ensure_ascii=True,
+                               escape_forward_slashes=False).encode('utf-8'))
 
-    bar.finish()
+    codecs['json'] = (lambda data: json.loads(data.decode('utf-8')),
+                      lambda obj: json.dumps(obj).encode('utf-8'))
 
-    return Error
+    return codecs
 
-def archive_filename(guide_filename):
+def orjson_dumps(obj):
     """
-    return the full path of the archive given guide_filename.
+    returns obj dumped by orjson, or by the json module when it has non ascii
+    characters since orjson cannot escape them.
     """
 
-    archive_name = 'pics.zip'
-    dirname = os.path.dirname(guide_filename)
+    data = orjson.dumps(obj)
+    if data.isascii():
+        return data
 
-    arch_filename = os.path.join(dirname,archive_name)
-    return arch_filename
+    # escaping the output of orjson in python is several times slower.
+    return json.dumps(obj).encode('utf-8')
 
+# the codec used to load and dump the guides, see set_json_codec.
+json_codec = next(iter(json_codecs().items()))
 
-def remove_from_zip(guide, removed_pic_name):
+def set_json_codec(name):
     """
-    Los Pollos Hermanos.
+    use the named codec to load and dump the guides. 'auto' picks the
+    fastest available one. Returns True if the codec is not available.
     """
 
-    # Get the filename of the tar archive.
-    archive_name = archive_filename(guide)
-    pic_set = set(removed_pic_name)
+    global json_codec
 
-    tmp_dest = '/tmp/pictures'
-    with ZipFile(archive_name, 'r') as z:
-        new_files = [n for n in z.namelist() if n not in pic_set]
-        z.extractall(tmp_dest, new_files)
+    codecs = json_codecs()
+    if name == 'auto':
+        name = next(iter(codecs))
 
-    with ZipFile(archive_name, 'w') as z:
-        for f in new_files:
-            z.write(os.path.join(tmp_dest, f),arcname=f)
+    if not name in codecs:
+        logging.error('the json codec {} is not available. Available codecs'\
+                ' are {}'.format(name, list(codecs)))
+        return True
 
-    # Delete the content of the tmp destination.
-    shutil.rmtree(tmp_dest)
+    json_codec = (name, codecs[name])
+    logging.info('using the {} json codec for the guides'.format(name))
+    return False
 
-    return
+def load_guide(guide):
+    """
+    returns the json content of the guide file.
+    """
 
-def editorial_publish(guides,
-                      endpoint,
-                      function_class,
-                      user_agent,
-                      nailgun_bin,
-                      content_generator):
+    with open(guide, 'rb') as file_guide:
+        data = file_guide.read()
+
+    name, (loads, dumps) = json_codec
+    try:
+        return loads(data)
+    except ValueError:
+        # the stdlib is more lenient with what it accepts (NaN, Infinity).
+        if name == 'json':
+            raise
+        return json.loads(data.decode('utf-8'))
+
+def dump_guide(content, guide):
     """
-    takes care of publishing the editorial content for the guides.
+    write the json content into the guide file.
     """
 
-    # init the nailgun thing for ed content generation.
-    nailguninit(nailgun_bin,content_generator)
+    name, (loads, dumps) = json_codec
+    try:
+        data = dumps(content)
+    except (TypeError, ValueError, OverflowError):
+        if name == 'json':
+            raise
+        data = json.dumps(content).encode('utf-8')
 
+    with open(guide, 'wb') as file_guide:
+        file_guide.write(data)
 
-    searches= {}
+    return
 
-    pbar = Bar('extracting editorial content for guides:',max=len(guides)+1)
-    pbar.start()
+def guide_content(guide):
+    """
+    return the content of a guide.
+    """
+
+    content = load_guide(guide)
+
+    if not content:
+        logging.error('problem while loading the content for {}'.format(guide))
+        return None
+    else:
+        return content
+
+def add_parse_address(guides, jobs=1, geocode_options=None):
+    """
+    Uses reverse geocoding to try and add a parsed version of the address.
+    geocode_options are passed on to parse_address_content.
+    """
+
+    return guide_stage(guides,
+                       'adding parsed address',
+                       [partial(parse_address_content,
+                                **(geocode_options or {}))],
+                       jobs=jobs)
+
+def parse_address_content(guide, content, cache_dir=None, cache_ttl=30,
+        cache_size=500000, precision=4, geocoder_data=None):
+    """
+    add the reverse geocoded address to every poi of the guide content.
+
+    When a cache_dir is given, the parsed addresses are cached there keyed
+    by the poi coordinates rounded to precision decimals, so that pois that
+    did not move, or that share a building, are not geocoded again.
+
+    When geocoder_data is given, the addresses are looked up all at once in
+    that local dataset with an OfflineGeocoder instead.
+    """
+
+    cache = None
+    if cache_dir:
+        cache = process_cache(cache_dir, 'reversegeo.sqlite', cache_ttl,
+                cache_size)
+
+    # get the pois
+    pois = None
+    try:
+        pois = content['Cities'][0]['pois']
+    except Exception as e:
+        logging.error('guide {} did not contain pois. Parsed address'\
+                ' will not be added.'.format(guide))
+        return False, False
 
+    if geocoder_data:
+        return offline_address_content(pois, process_geocoder(geocoder_data))
+
+    changed = False
     error = False
-    for i, guide in enumerate(guides):
-        jsonguide = None
-        with open(guide,'r') as g:
-            jsonguide = json.load(g)
+    for p in pois:
+        latitude = get_in(p, "location", "latitude")
+        longitude = get_in(p, "location", "longitude")
 
-        if not jsonguide:
-            logging.error('could not load json from {0}'.format())
-            error = True
-            continue
-        search = cityinfo.cityinfo(jsonguide)
-        uri = cityres.cityres(search,endpoint)
-        if not uri:
-            logging.error(
-                    'no dbpedia resource was found for {0}'.format(guide))
-            error = True
-            continue
-        urls = urlinfer.urlinferdef([unquote(uri)])
-        if len(urls) < 1:
-            logging.error('no wikipedia/wikivoyage urls found/inferred'\
-                   ' for resource {0}'.format(uri))
+        try:
+            key = None
+            parsed = None
+            if cache and latitude is not None and longitude is not None:
+                key = '{0:.{2}f},{1:.{2}f}'.format(float(latitude),
+                        float(longitude), precision)
+                parsed = cache.get(key)
+                counters['reversegeo cache hits' if parsed else
+                         'reversegeo cache misses'] += 1
+
+            if parsed is None:
+                coords = ", ".join([str(latitude),str(longitude)])
+                with external_call('reversegeo'):
+                    parsed = reversegeo.reverse_geocode(coords)
+                if key and parsed:
+                    cache.put(key, parsed)
+
+            changed |= assoc(p['address'], 'parsed', parsed)
+        except:
             error = True
+            logging.error('could not add parsed address to a poi ...')
+
+    return changed, error
+
+def offline_address_content(pois, geocoder):
+    """
+    add to every poi the parsed address of the closest entry of the
+    offline geocoder, looking them all up in a single batch.
+    """
+
+    located = []
+    for p in pois:
+        latitude = get_in(p, "location", "latitude")
+        longitude = get_in(p, "location", "longitude")
+        if latitude is None or longitude is None:
+            logging.error('could not add parsed address to a poi ...')
             continue
-        content = editorial_content(urls,function_class,user_agent)
-        if not content:
-            logging.error('no editorial content could be'\
-                    ' generated for {0}'.format(guide))
+        located.append((p, (float(latitude), float(longitude))))
+
+    with external_call('offline reversegeo'):
+        addresses = geocoder.reverse_geocode([c for p, c in located])
+
+    changed = False
+    error = len(located) < len(pois)
+    for (p, coordinates), parsed in zip(located, addresses):
+        if parsed is None or not 'address' in p:
             error = True
+            logging.error('could not add parsed address to a poi ...')
             continue
 
-        #insert the content into the guide
-        jsonsert.jsonsert(content, guide)
+        changed |= assoc(p['address'], 'parsed', dict(parsed))
 
-        logging.info('editorial content for {0} sucessfully'\
-                ' inserted.'.format(guide))
-        pbar.next()
+    return changed, error
+
+def remove_street_picture(guides, jobs=1, stream=False):
+    """
+    Remove pictures from the poi when the subcategory is street.
+    """
+
+    if stream:
+        return guide_stage(guides,
+                           'removing street pics',
+                           [stream_transform(remove_street_picture_stream,
+                               finish=remove_street_picture_finish)],
+                           jobs=jobs,
+                           stream=True)
+
+    return guide_stage(guides,
+                       'removing street pics',
+                       [remove_street_picture_content],
+                       jobs=jobs)
+
+def remove_street_picture_content(guide, content):
+    """
+    Remove pictures from the poi of the guide content when the subcategory
+    is street.
+    """
+
+    # get the pois
+    pois = None
+    try:
+        pois = content['Cities'][0]['pois']
+    except Exception as e:
+        logging.error('guide {} did not contain pois. Street picture'\
+                ' will not be removed.'.format(guide))
+        return False, False
+
+    removed_pic_name = []
+    for p in pois:
+        pic = remove_street_picture_poi(p)
+        if pic:
+            removed_pic_name.append(pic)
+
+    error = False
+    if removed_pic_name:
+        with external_call('zip remove'):
+            error = remove_from_zip(guide, removed_pic_name)
+
+    changed = len(removed_pic_name) > 0
+    return changed, error
+
+def remove_street_picture_poi(poi):
+    """
+    Remove the picture of the poi if its subcategory is street. Returns the
+    name of the removed picture, if any.
+    """
+
+    if poi.get('subcategory') != 'street':
+        return None
+
+    try:
+        pic = poi['picture']['picture']
+        poi.pop('picture')
+        return pic
+    except Exception as e:
+        return None
+
+def remove_street_picture_stream(guide, poi, state):
+    """
+    Remove the picture of the poi streamed from the guide if it is a street.
+    The pictures are removed from the archive once the guide is written.
+    """
+
+    pic = remove_street_picture_poi(poi)
+    if pic:
+        state.setdefault('removed_pic_name', []).append(pic)
+
+    return True, pic is not None, False
+
+def remove_street_picture_finish(guide, state):
+    """
+    Remove the street pictures of the streamed guide from its archive.
+    """
+
+    removed_pic_name = state.get('removed_pic_name')
+    if removed_pic_name:
+        with external_call('zip remove'):
+            return remove_from_zip(guide, removed_pic_name)
+
+    return False
+
+def archive_filename(guide_filename):
+    """
+    return the full path of the archive given guide_filename.
+    """
+
+    archive_name = 'pics.zip'
+    dirname = os.path.dirname(guide_filename)
+
+    arch_filename = os.path.join(dirname,archive_name)
+    return arch_filename
+
+
+def remove_from_zip(guide, removed_pic_name):
+    """
+    remove the pictures named in removed_pic_name from the pics.zip archive
+    of the guide. The kept entries are copied as they are, still compressed,
+    into a new archive which then atomically replaces the old one. Returns
+    True if the archive could not be rewritten.
+    """
+
+    # Get the filename of the archive.
+    archive_name = archive_filename(guide)
+    pic_set = set(removed_pic_name)
+
+    if not os.path.exists(archive_name):
+        return False
+
+    tmp_name = None
+    try:
+        with open(archive_name, 'rb') as old:
+            entries, cd_offset = zip_entries(old)
+
+            kept = [e for e in entries if not e[0] in pic_set]
+            if len(kept) == len(entries):
+                return False
+
+            # the local header, data and data descriptor of an entry span up
+            # to the next entry, or to the central directory for the last.
+            offsets = sorted(e[1] for e in entries) + [cd_offset]
+            ends = dict(zip(offsets, offsets[1:]))
+
+            fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(archive_name),
+                                            suffix='.zip')
+            with os.fdopen(fd, 'wb') as new:
+                records = []
+                for name, offset, record in kept:
+                    old.seek(offset)
+                    new_offset = new.tell()
+                    new.write(old.read(ends[offset] - offset))
+                    records.append(record[:42] +
+                                   struct.pack('<I', new_offset) +
+                                   record[46:])
+
+                new_cd_offset = new.tell()
+                for record in records:
+                    new.write(record)
+                new_cd_size = new.tell() - new_cd_offset
+
+                new.write(struct.pack('<4s4H2LH',
+                                      b'PK\x05\x06',
+                                      0,
+                                      0,
+                                      len(records),
+                                      len(records),
+                                      new_cd_size,
+                                      new_cd_offset,
+                                      0))
+
+        shutil.copymode(archive_name, tmp_name)
+        os.replace(tmp_name, archive_name)
+
+    except (OSError, BadZipFile, struct.error) as e:
+        logging.error('could not remove {0} from {1}: {2}'.format(
+            removed_pic_name, archive_name, e))
+        if tmp_name and os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        return True
+
+    return False
+
+def zip_entries(archive):
+    """
+    read the central directory of the zip archive file object. Returns the
+    list of the (filename, local header offset, central directory record)
+    of its entries and the offset of the central directory.
+    """
+
+    # the end of central directory record is at the end of the archive,
+    # only followed by an optional comment of at most 64KB.
+    archive.seek(0, 2)
+    size = archive.tell()
+    tail_size = min(size, 22 + 0xFFFF)
+    archive.seek(size - tail_size)
+    tail = archive.read(tail_size)
+
+    end = tail.rfind(b'PK\x05\x06')
+    if end < 0:
+        raise BadZipFile('no end of central directory record')
+
+    (signature, disk, cd_disk, disk_entries, nbr_entries, cd_size, cd_offset,
+            comment_len) = struct.unpack('<4s4H2LH', tail[end:end+22])
+
+    if nbr_entries == 0xFFFF or cd_offset == 0xFFFFFFFF:
+        raise BadZipFile('zip64 archives are not supported')
+
+    archive.seek(cd_offset)
+    central = archive.read(cd_size)
+
+    entries = []
+    pos = 0
+    for i in range(nbr_entries):
+        (signature, flags, name_len, extra_len, comment_len,
+                offset) = struct.unpack('<4s4xH18xHHH8xL', central[pos:pos+46])
+
+        if signature != b'PK\x01\x02':
+            raise BadZipFile('bad central directory record')
+
+        raw_name = central[pos+46:pos+46+name_len]
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+
+        record_len = 46 + name_len + extra_len + comment_len
+        entries.append((name, offset, central[pos:pos+record_len]))
+        pos += record_len
+
+    return entries, cd_offset
+
+def editorial_publish(guides,
+                      endpoint,
+                      function_class,
+                      user_agent,
+                      nailgun_bin,
+                      content_generator,
+                      cache=None,
+                      concurrency=1):
+    """
+    takes care of publishing the editorial content for the guides. The city
+    resolution is taken from the cache when one is given. The content of up
+    to concurrency guides is generated at the same time.
+    """
+
+    # init the nailgun thing for ed content generation.
+    nailguninit(nailgun_bin,content_generator)
+
+    def publish_guide(guide):
+        start = time.time()
+        guide_error = editorial_guide(guide,
+                                      endpoint,
+                                      function_class,
+                                      user_agent,
+                                      cache)
+        metrics.guides([guide], time.time() - start)
+        return guide_error
+
+    pbar = Bar('extracting editorial content for guides:',max=len(guides))
+    pbar.start()
+
+    error = False
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(publish_guide, g): g for g in guides}
+        for future in as_completed(futures):
+            guide = futures[future]
+            try:
+                guide_error = future.result()
+            except Exception as e:
+                logging.error('could not publish the editorial content of'\
+                        ' {0}: {1}'.format(guide, e))
+                guide_error = True
+
+            if not guide_error:
+                checkpoint([guide])
+            error |= guide_error
+            pbar.next()
 
     pbar.finish()
     return error
 
+def editorial_guide(guide, endpoint, function_class, user_agent, cache=None):
+    """
+    publish the editorial content of a single guide. Returns True if it
+    could not be generated.
+    """
+
+    jsonguide = load_guide(guide)
+    if not jsonguide:
+        logging.error('could not load json from {0}'.format(guide))
+        return True
+
+    search = cityinfo.cityinfo(jsonguide)
+    uri = memoize(cache, guide, 'uri:' + search_key(search),
+            cityres.cityres, search, endpoint)
+    if not uri:
+        logging.error(
+                'no dbpedia resource was found for {0}'.format(guide))
+        return True
+
+    urls = memoize(cache, guide, 'def:' + unquote(uri),
+            urlinfer.urlinferdef, [unquote(uri)])
+    if len(urls) < 1:
+        logging.error('no wikipedia/wikivoyage urls found/inferred'\
+               ' for resource {0}'.format(uri))
+        return True
+
+    content = editorial_content(urls,function_class,user_agent)
+    if not content:
+        logging.error('no editorial content could be'\
+                ' generated for {0}'.format(guide))
+        return True
+
+    #insert the content into the guide
+    jsonsert.jsonsert(content, guide)
+
+    logging.info('editorial content for {0} sucessfully'\
+            ' inserted.'.format(guide))
+    return False
+
 
 def editorial_content(urls, class_path, user_agent):
     """
     from a collection of given url, generate some editorial content.
     """
-    quoted_urls = quote_urls(urls)
-    urls_args = " ".join(quoted_urls)
-    ed_gen_template = 'ng-nailgun {0} -u "{1}" {2} &> /dev/null'
-    ed_gen_instance = ed_gen_template.format(class_path, user_agent, urls_args)
 
-    content = subprocess.check_output(ed_gen_instance, shell=True,
-            universal_newlines=True)
+    args = ['-u', user_agent] + [unquote(u) for u in urls]
+    content = nailgun(class_path, args)
 
     return content
 
-def quote_urls(urls):
+def memoize(cache, guide, key, f, *args):
+    """
+    returns f(*args), taking it from cache under key when it is there. The
+    key is recorded against the id of guide so that it can be invalidated
+    with invalidate_guide. Empty results are not cached.
     """
-    takes a list of url string and quote them, if need be, for usage inside
-    a shell invocation string"
 
-    EXAMPLE
-    =======
+    call = getattr(f, '__name__', 'memoized')
+    if cache is None:
+        with external_call(call):
+            return f(*args)
 
-    # non quoted urls are quoted
-    >>> quote_urls(['http://en.wikipedia.org', 'http://ru.wiki.ru/stuff'])
-    ['"http://en.wikipedia.org"', '"http://ru.wiki.ru/stuff"']
+    value = cache.get(key)
+    if not value:
+        with external_call(call):
+            value = f(*args)
+        if value:
+            cache.put(key, value)
 
-    # already quoted urls are left untouched.
-    >>> quote_urls(['"http://exp.com"', 'http://google.com'])
-    ['"http://exp.com"', '"http://google.com"']
+    # record hits too, the value may have been cached for another guide.
+    city_id = guide_id(guide)
+    if value and city_id is not None:
+        cache.tag(str(city_id), key)
 
-    # aplication on empty list is idempotent
-    >>> quote_urls([])
-    []
+    return value
+
+def invalidate_guide(cache, city_id):
+    """
+    remove from cache all the values memoized for the guide city_id.
+    """
+
+    keys = cache.tagged(str(city_id))
+
+    for key in keys:
+        cache.delete(key)
+    cache.untag(str(city_id))
+
+    logging.info('invalidated {} cached values for guide {}'.format(
+        len(keys), city_id))
+    return
+
+def search_key(search):
+    """
+    returns a cache key for a cityinfo search.
+    """
+
+    return json.dumps(search, sort_keys=True, default=str)
+
+def nailgun_call(command, args, host=None, port=None, timeout=None):
+    """
+    run command with args on the nailgun server by speaking the nailgun
+    protocol directly instead of forking the ng-nailgun client. Returns
+    what the command wrote on stdout and, like subprocess.check_output,
+    raises CalledProcessError if it exited with a non 0 status.
+
+    The server defaults to NAILGUN_SERVER:NAILGUN_PORT from the
+    environment, as for the ng-nailgun client, or 127.0.0.1:2113. Nailgun
+    runs a single command per connection so one is opened per call.
+
+    With a timeout, socket.timeout is raised if the server does not accept
+    the connection, or stays silent, for that many seconds.
+    """
+
+    default_host, default_port = nailgun_address()
+    host = host or default_host
+    port = port or default_port
+
+    stdout = []
+    status = None
+    with external_call('nailgun'), \
+            socket.create_connection((host, port), timeout) as ng:
+        for arg in args:
+            nailgun_send(ng, b'A', arg)
+        nailgun_send(ng, b'D', os.getcwd())
+        nailgun_send(ng, b'C', command)
+
+        while status is None:
+            chunk_type, payload = nailgun_recv(ng)
+            if chunk_type == b'1':
+                stdout.append(payload)
+            elif chunk_type == b'2':
+                logging.debug('nailgun {}: {}'.format(command,
+                    payload.decode('utf-8', 'replace').strip()))
+            elif chunk_type == b'S':
+                # the command wants to read stdin. We have nothing for it.
+                nailgun_send(ng, b'.', '')
+            elif chunk_type == b'X':
+                status = int(payload.decode('ascii').strip())
+
+    output = b''.join(stdout).decode('utf-8').replace('\r\n', '\n')
+    if status != 0:
+        raise subprocess.CalledProcessError(status, [command] + args, output)
+
+    return output
+
+def nailgun_send(ng, chunk_type, payload):
+    """
+    send a chunk of chunk_type with the given string payload to nailgun.
+    """
+
+    data = payload.encode('utf-8')
+    ng.sendall(struct.pack('>Ic', len(data), chunk_type) + data)
+    return
+
+def nailgun_recv(ng):
+    """
+    read a chunk from nailgun and return its (type, payload) tuple.
+    """
 
+    header = recv_exactly(ng, 5)
+    length, chunk_type = struct.unpack('>Ic', header)
+
+    return chunk_type, recv_exactly(ng, length)
+
+def recv_exactly(sock, size):
     """
-    def is_quoted(url):
-        """ return true if a url is quoted, false otherwise."""
-        return len(url) > 1 and url[0] == '"' and url[-1] == '"'
+    read exactly size bytes from sock.
+    """
+
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionResetError('nailgun closed the connection')
+        data.extend(part)
 
-    def wrap(s,sym):
-        """ returns a string wrapped with sym """
-        return '{0}{1}{0}'.format(sym,s)
+    return bytes(data)
 
-    return [u if is_quoted(u) else wrap(u,'"') for u in urls]
+# the nailgun servers used by this process, see nailguninit.
+nailgun_pool = None
 
-def nailguninit(path, jar):
+def nailguninit(path, *jars, servers=1, port=None):
     """
     takes care of starting the nailgun thing if not already started.
     The function will set the correct nailgun class path to use the
-    editorial content jar specified by the user.
+    jars specified by the user.
     This is included for portability but nailgun should usually be started on
     the mtrip datastore machine.
+
+    servers nailgun servers are started once, on consecutive ports from
+    port, and reused by all the stages: a server already answering is kept
+    and only the jars it is missing are added to its classpath. A server is
+    restarted if it does not answer anymore.
     """
 
-    print("starting nailgun ...")
-    subprocess.call("ng-nailgun ng-stop &> /dev/null", shell=True)
+    global nailgun_pool
+    if nailgun_pool is None:
+        nailgun_pool = NailgunPool(path, servers, port=port)
 
-    sleep(2)
-    ng_shell_template = "java -jar {0} &> /dev/null &"
-    ng_shell_instance = ng_shell_template.format(path)
-    res = subprocess.call(ng_shell_instance, shell=True)
-    if not res == 0:
+    if nailgun_pool.ensure(jars):
         logging.critical('could not start nailgun'\
-                'with {0} as the specified location. Is the'\
-                ' given path spelled correctly?')
+                ' with {0} as the specified location and {1} on its'\
+                ' classpath. Are the given paths spelled'\
+                ' correctly?'.format(path, jars))
         die('critical:could not init nailgun. See log file for detail')
 
-    # to make sure that nailgun is properly started before adding the
-    # classpath
-    print("adding classpath to nailgun")
-    sleep(2)
-
-    ng_cp_template = "ng-nailgun ng-cp {0} &> /dev/null"
-    ng_cp_instance = ng_cp_template.format(jar )
-    res = subprocess.call(ng_cp_instance, shell=True)
-    if not res == 0:
-        logging.critical(
-                'could not add {0} to the nailgun classpath. Is the '\
-                'path to the .jar correct?.'.format(jar))
-        die('critical:could not configure nailgun. See log file for'\
-        'detail')
-
-    logging.info('successfully started and configured nailgun')
-    sleep(1)
     return
 
 def nailgunstop():
@@ -1303,9 +2894,34 @@ def nailgunstop():
     shutdown nailgun .
     """
 
-    subprocess.call("ng-nailgun ng-stop &> /dev/null", shell=True)
+    global nailgun_pool
+    if nailgun_pool:
+        nailgun_pool.stop()
+        nailgun_pool = None
+
     return
 
+def nailgun(command, args):
+    """
+    run command with args on the least busy of the nailgun servers started
+    by nailguninit, or on the default nailgun server. See nailgun_call.
+    """
+
+    if nailgun_pool:
+        return nailgun_pool.call(command, args)
+
+    return nailgun_call(command, args)
+
+def nailgun_address():
+    """
+    returns the (host, port) of the nailgun server from NAILGUN_SERVER and
+    NAILGUN_PORT in the environment, as for the ng-nailgun client, or
+    127.0.0.1:2113.
+    """
+
+    return (os.environ.get('NAILGUN_SERVER', '127.0.0.1'),
+            int(os.environ.get('NAILGUN_PORT', 2113)))
+
 def die(msg, error_code=-1):
     """ print an error message on stderr and exit the program with a
     non 0 error code. Default error code is -1"""
@@ -1313,94 +2929,1630 @@ def die(msg, error_code=-1):
     sys.stderr.write("{0}\n".format(msg))
     exit(error_code)
 
-def list_guide(path, guide_name):
+def list_guide(path, guide_name, index=False, workers=1):
     """
     returns a list of all the mtrip guide files that can be found under
     path.
+
+    With index, the guide found in each directory is kept in an index under
+    path and the directories are only scanned again when their modification
+    time changed. The directories are scanned by workers threads.
     """
 
-    # list all directories in the path.
-    directories = [os.path.join(path,d) for d in os.listdir(path) if os.path.isdir(os.path.join(path,d))]
+    guide_index = load_guide_index(path, guide_name) if index else {}
+    scan_time = time.time()
 
-    # get the result filename from the dir
-    guides = [guide_file(d,guide_name) for d in directories if guide_file(d, guide_name)]
+    with os.scandir(path) as entries:
+        directories = [e.name for e in entries if e.is_dir()]
+
+    known = guide_index.get('directories', {})
+    scan = partial(scan_guide_dir, path, guide_name, known)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scanned = list(executor.map(scan, directories))
+    else:
+        scanned = [scan(d) for d in directories]
+
+    guides = [os.path.join(path, d, g) for d, (mtime, g) in
+              zip(directories, scanned) if g]
+
+    if index:
+        # a directory modified right before the scan may be modified again
+        # within the resolution of its modification time, so it is not
+        # trusted. See racily clean entries in git.
+        racy = int((scan_time - racy_seconds) * 1e9)
+        save_guide_index(path, {
+            'guide_name': guide_name,
+            'directories': {d: [mtime if mtime and mtime < racy else None, g]
+                for d, (mtime, g) in zip(directories, scanned)}
+            })
 
     return guides
 
-def guide_file(path,guide_name):
-    """ Return the json filename guide found in path. None if it cannot be
-    found. """
+guide_index_name = '.publish-index.json'
+racy_seconds = 2
+
+def load_guide_index(path, guide_name):
+    """
+    returns the guide index under path. It is empty if it does not exist or
+    was made for another guide name.
+    """
 
-    dir_content = [os.path.join(path,content) for content in os.listdir(path) if guide_name in os.path.join(path,content)]
+    try:
+        with open(os.path.join(path, guide_index_name), 'r') as i:
+            guide_index = json.load(i)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.error('the guide index under {} is corrupted. All the'\
+                ' directories will be scanned'.format(path))
+        return {}
 
-    if len(dir_content) > 0:
-        return dir_content[0]
-    else:
-        return None
+    if guide_index.get('guide_name') != guide_name:
+        return {}
+
+    return guide_index
 
-def remove_homepage_guide(guide_name, domains):
+def save_guide_index(path, guide_index):
     """
-    remove the bad homepage from the guide.
+    atomically write the guide index under path.
     """
 
-    domains_set = set(domains)
+    filename = os.path.join(path, guide_index_name)
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as i:
+            json.dump(guide_index, i)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        logging.error('could not save the guide index under {}: {}'.format(
+            path, e))
 
-    with open(guide_name,'r') as guide:
-        content = json.load(guide, object_pairs_hook = collections.OrderedDict)
+    return
 
-    if not content:
-        error = True
-        return error
+def scan_guide_dir(path, guide_name, known, directory):
+    """
+    returns the (modification time, guide filename) of the directory under
+    path. The guide filename is None if there is none. The known
+    (modification time, guide filename) of the directories are used when
+    the modification time is unchanged.
+    """
+
+    folder = os.path.join(path, directory)
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+        if directory in known and known[directory][0] == mtime:
+            return mtime, known[directory][1]
+
+        return mtime, guide_file(folder, guide_name, full_path=False)
+    except OSError as e:
+        logging.error('could not scan {}: {}'.format(folder, e))
+        return None, None
+
+def guide_file(path,guide_name, full_path=True):
+    """ Return the json filename guide found in path. None if it cannot be
+    found. Only the name of the file is returned unless full_path. """
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            filename = os.path.join(path, entry.name)
+            if guide_name in filename:
+                return filename if full_path else entry.name
+
+    return None
+
+def remove_homepage_content(guide, content, domains):
+    """
+    remove the homepage of the poi of the guide content that match one of
+    the given domains.
+    """
+
+    domains_set = set(domains)
 
     pois = None
 
     try:
         pois = content['Cities'][0]['pois']
     except KeyError:
-        logging.error('{0} contained no POIs. Skipping'.format(guide_name))
-        error = True
-        return error
+        logging.error('{0} contained no POIs. Skipping'.format(guide))
+        logging.error('could not remove the bad homepage from {0}'.format(
+            guide))
+        return False, True
 
+    changed = False
     for poi in pois:
-        try:
-            homepage = poi['homepage']['homepage']
-            parsed_homepage = urlparse(homepage)
-            full_homepage_domain = parsed_homepage.netloc
-            tld = full_homepage_domain.split(".")[-2]
-            if tld in domains_set:
-                poi['homepage'] = {"homepage" : None}
-        except Exception:
-            pass
+        changed |= remove_homepage_poi(poi, domains_set)
 
-    error = True
-    with open(guide_name,'w') as guide:
-        json.dump(content,guide)
-        error = False
+    return changed, False
 
-    return error
-
-def remove_homepage_from_domains(guides,domains):
+def remove_homepage_poi(poi, domains_set):
     """
-    for all the guides, will remove the homepage of the poi that match a
-    given domain.
+    remove the homepage of the poi if it matches one of the domains. Returns
+    True if it was removed.
     """
-    pbar = Bar('removing bad homepages from guides',max=len(guides)+1)
-    pbar.start()
-
-    error = False
-    for i,g in enumerate(guides):
-        remove_error = remove_homepage_guide(g,domains)
-        if remove_error:
-            logging.error("could not remove the bad homepage'\
-                    ' from {0}".format(g))
-            error |= True
 
-        pbar.next()
+    try:
+        homepage = poi['homepage']['homepage']
+        parsed_homepage = urlparse(homepage)
+        full_homepage_domain = parsed_homepage.netloc
+        tld = full_homepage_domain.split(".")[-2]
+        if tld in domains_set:
+            poi['homepage'] = {"homepage" : None}
+            return True
+    except Exception:
+        pass
 
-    pbar.finish()
+    return False
+
+def remove_homepage_stream(guide, poi, state, domains):
+    """
+    remove the homepage of the poi streamed from the guide if it matches one
+    of the given set of domains.
+    """
+
+    return True, remove_homepage_poi(poi, domains), False
+
+def remove_homepage_from_domains(guides,domains, jobs=1, stream=False):
+    """
+    for all the guides, will remove the homepage of the poi that match a
+    given domain.
+    """
+
+    if stream:
+        return guide_stage(guides,
+                           'removing bad homepages from guides',
+                           [stream_transform(remove_homepage_stream,
+                               domains=frozenset(domains))],
+                           jobs=jobs,
+                           stream=True)
+
+    return guide_stage(guides,
+                       'removing bad homepages from guides',
+                       [partial(remove_homepage_content, domains=domains)],
+                       jobs=jobs)
+
+def guide_stage(guides, title, transforms, jobs=1, chunk_size=1,
+        stream=False):
+    """
+    apply the transforms to every guide, showing the progress under title.
+    The guides are loaded and transformed chunk_size at a time. When jobs
+    is greater than 1 the chunks are fanned out to that many worker
+    processes. With stream, the transforms are stream transforms applied to
+    the pois as the guides are streamed (see stream_guides). Returns True
+    if an error occured for any of the guides.
+    """
+
+    bar = Bar(title, max=len(guides))
+    bar.start()
+
+    error = False
+    if jobs > 1:
+        # the workers open their own connections.
+        close_process_connections()
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=init_worker,
+                                 initargs=(transforms, stream)) as executor:
+            futures = {executor.submit(worker_transform_guides, chunk): chunk
+                       for chunk in chunks(guides, chunk_size)}
+
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    chunk_error, worker_counters, worker_metrics, \
+                            worker_timings = future.result()
+                    error |= chunk_error
+                    counters.update(worker_counters)
+                    metrics.merge(worker_metrics)
+                    merge_db_timings(worker_timings)
+                    if not chunk_error:
+                        checkpoint(chunk)
+                except Exception as e:
+                    logging.error('could not process {}: {}'.format(chunk, e))
+                    error = True
+                bar.next(len(chunk))
+    else:
+        for chunk in chunks(guides, chunk_size):
+            chunk_error = stage_guides(chunk, transforms, stream)
+            if not chunk_error:
+                checkpoint(chunk)
+            error |= chunk_error
+            bar.next(len(chunk))
+
+    bar.finish()
+    return error
+
+worker_transforms = []
+worker_stream = False
+
+def init_worker(transforms, stream=False):
+    """
+    setup a guide stage worker process with the transforms it must apply.
+    """
+
+    global worker_transforms, worker_stream
+    worker_transforms = transforms
+    worker_stream = stream
+
+    # the parent closed its connections before forking, see guide_stage.
+    counters.clear()
+    metrics.clear()
+    db_timings.clear()
+    return
+
+def worker_transform_guides(guides):
+    """
+    apply the transforms of the worker process to the guides. Returns the
+    error along with the counters, metrics and db statement timings gathered
+    while doing it.
+    """
+
+    error = stage_guides(guides, worker_transforms, worker_stream)
+
+    worker_counters = dict(counters)
+    counters.clear()
+
+    worker_metrics = metrics.snapshot()
+    metrics.clear()
+
+    worker_timings = dict(db_timings)
+    db_timings.clear()
+
+    return error, worker_counters, worker_metrics, worker_timings
+
+def stage_guides(guides, transforms, stream=False):
+    """
+    apply the transforms, or stream transforms, to the guides and record
+    the time spent on them.
+    """
+
+    start = time.time()
+    if stream:
+        error = stream_guides(guides, transforms)
+    else:
+        error = transform_guides(guides, transforms)
+
+    metrics.guides(guides, time.time() - start)
+    return error
+
+def transform_guide(guide, transforms):
+    """
+    load the guide once, pass its content through the chain of transforms
+    and dump it back only if one of them changed it.
+    """
+
+    return transform_guides([guide], transforms)
+
+def transform_guides(guides, transforms):
+    """
+    load the guides once, pass their content through the chain of
+    transforms and dump back the ones that were changed.
+
+    A transform is called with the guide filename and its content, modifies
+    the content in place and returns a (changed, error) tuple. A batch
+    transform (see batch_transform) is called once with the list of the
+    (guide, content) items and returns the list of their (changed, error).
+    """
+
+    error = False
+    items = []
+    for guide in guides:
+        content = guide_content(guide)
+        if not content:
+            error = True
+        else:
+            items.append((guide, content))
+
+    changed = [False] * len(items)
+    for transform in transforms:
+        if getattr(transform, 'batch', False):
+            results = transform(items)
+        else:
+            results = [transform(guide, content) for guide, content in items]
+
+        for i, (transform_changed, transform_error) in enumerate(results):
+            changed[i] |= transform_changed
+            error |= transform_error
+
+    for (guide, content), guide_changed in zip(items, changed):
+        if guide_changed:
+            dump_guide(content, guide)
+
+    return error
+
+def batch_transform(f, **kwargs):
+    """
+    returns f, with kwargs bound, as a transform applied to a whole chunk of
+    guides at once by transform_guides.
+    """
+
+    transform = partial(f, **kwargs)
+    transform.batch = True
+    return transform
+
+def stream_transform(function, finish=None, **kwargs):
+    """
+    returns function, with kwargs bound, as a transform of the pois streamed
+    from a guide by stream_guides. finish, if any, is called once the guide
+    is written.
+    """
+
+    transform = partial(function, **kwargs)
+    transform.finish = finish
+    return transform
+
+def stream_guides(guides, transforms):
+    """
+    stream the pois of the guides through the chain of stream transforms.
+    Returns True if an error occured for any of the guides.
+    """
+
+    error = False
+    for guide in guides:
+        error |= stream_guide(guide, transforms)
+
+    return error
+
+# the pois of a guide and their array, as prefixed by ijson.
+poi_prefix = 'Cities.item.pois.item'
+pois_prefix = 'Cities.item.pois'
+
+def stream_guide(guide, transforms):
+    """
+    parse the guide incrementally and pass each of its pois, one at a time,
+    through the chain of transforms while the guide is written back. Only
+    one poi is held in memory at a time. The guide is replaced only if one
+    of the transforms changed it.
+
+    A stream transform is called with the guide filename, a poi and a state
+    dictionary shared by all the pois of the guide. It modifies the poi in
+    place and returns a (keep, changed, error) tuple. The poi is removed
+    from the guide when keep is False. The finish function of a transform
+    (see stream_transform) is then called with the guide and the state. A
+    guide without pois is an error, as it is for the in-memory transforms.
+    """
+
+    folder = os.path.dirname(guide) or '.'
+    fd, tmp_guide = tempfile.mkstemp(dir=folder, suffix='.json')
+
+    state = {}
+    changed = False
+    error = False
+    has_pois = False
+    try:
+        with open(guide, 'rb') as src, \
+                open(fd, 'w', encoding='utf-8') as dst:
+            writer = JSONWriter(dst)
+            builder = None
+            for prefix, event, value in ijson.parse(src, use_float=True):
+                if builder is None:
+                    if prefix == poi_prefix and event == 'start_map':
+                        builder = ijson.ObjectBuilder()
+                    else:
+                        has_pois |= prefix == pois_prefix \
+                                and event == 'start_array'
+                        writer.event(event, value)
+                        continue
+
+                builder.event(event, value)
+                if prefix != poi_prefix or event != 'end_map':
+                    continue
+
+                poi = builder.value
+                builder = None
+
+                keep = True
+                for transform in transforms:
+                    keep, poi_changed, poi_error = transform(guide, poi, state)
+                    changed |= poi_changed
+                    error |= poi_error
+                    if not keep:
+                        break
+
+                if keep:
+                    writer.value(poi)
+
+    except (ijson.JSONError, ValueError) as e:
+        logging.error('could not stream the content of {}: {}'.format(guide,
+            e))
+        os.remove(tmp_guide)
+        return True
+    except:
+        os.remove(tmp_guide)
+        raise
+
+    if not has_pois:
+        logging.error('{0} contained no POIs. Skipping'.format(guide))
+        os.remove(tmp_guide)
+        return True
+
+    if changed:
+        shutil.copymode(guide, tmp_guide)
+        os.replace(tmp_guide, guide)
+    else:
+        os.remove(tmp_guide)
+
+    for transform in transforms:
+        finish = getattr(transform, 'finish', None)
+        if finish:
+            error |= finish(guide, state)
 
     return error
 
+# the order in which the publish stages run.
+publish_order = (
+        'description',
+        'reversegeo',
+        'attraction-remove',
+        'remove-street-pic',
+        'banner',
+        'zipcode-remove',
+        'homepage-remove',
+        'categories',
+        'iso3166',
+        'guesslang',
+        'city-name-translation',
+        'iata',
+        'editorial'
+        )
+
+# the stages that only transform the guide content, see pipeline_publish.
+pipeline_choices = (
+        'reversegeo',
+        'attraction-remove',
+        'remove-street-pic',
+        'homepage-remove',
+        'categories',
+        'iso3166',
+        'city-name-translation',
+        'iata'
+        )
+
+def pipeline_segments(functions):
+    """
+    returns the runs of consecutive in-memory stages among the publish
+    functions, in the order they run. Each run can be done in a single pass
+    without changing the order of the stages. Any other stage that is
+    published breaks the run.
+
+    EXAMPLE
+    =======
+
+    >>> pipeline_segments(['iata', 'categories', 'reversegeo'])
+    [['reversegeo', 'categories', 'iata']]
+
+    >>> pipeline_segments(['reversegeo', 'banner', 'categories', 'iso3166'])
+    [['reversegeo'], ['categories', 'iso3166']]
+
+    """
+
+    segments = [[]]
+    for stage in publish_order:
+        if stage in pipeline_choices and stage in functions:
+            segments[-1].append(stage)
+        elif stage in functions and segments[-1]:
+            segments.append([])
+
+    return [s for s in segments if s]
+
+def pipeline_transforms(guides, stages, homepage_domains, dbconf,
+        chunk_size=200, geocode_options=None):
+    """
+    returns the chain of transforms that implement the given in-memory
+    publish stages for the guides, in the order the stages are given.
+    """
+
+    names = None
+    if 'city-name-translation' in stages:
+        names = alternate_names(dbconf, guides, chunk_size)
+
+    transforms = {
+            'reversegeo': partial(parse_address_content,
+                                  **(geocode_options or {})),
+            'attraction-remove': partial(filter_poi_content,
+                                         f=must_remove_attraction),
+            'remove-street-pic': remove_street_picture_content,
+            'homepage-remove': partial(remove_homepage_content,
+                                       domains=homepage_domains),
+            'categories': categories_content,
+            'iso3166': country_code_content,
+            'city-name-translation': partial(alternate_names_content,
+                                             names=names),
+            'iata': batch_transform(iata_content, conf=dbconf)
+            }
+
+    return [transforms[s] for s in stages]
+
+def pipeline_publish(guides, stages, homepage_domains, dbconf, jobs=1,
+        chunk_size=200, geocode_options=None):
+    """
+    run all the given in-memory stages in a single pass: every guide is
+    loaded once, goes through all the stages and is written back at most
+    once. chunk_size bounds the number of guides per database query, and
+    so the number of guides loaded at once by the iata stage.
+    """
+
+    transforms = pipeline_transforms(guides,
+                                     stages,
+                                     homepage_domains,
+                                     dbconf,
+                                     chunk_size,
+                                     geocode_options)
+
+    return guide_stage(guides,
+                       'running {} on the guides'.format(', '.join(stages)),
+                       transforms,
+                       jobs=jobs,
+                       chunk_size=chunk_size if 'iata' in stages else 1)
+
+def chunks(items, size):
+    """
+    split items in lists of at most size elements.
+
+    EXAMPLE
+    =======
+
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+
+    >>> list(chunks([], 2))
+    []
+
+    """
+
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def assoc(obj, key, value):
+    """
+    set key to value in obj. Returns True if obj was changed by it.
+
+    EXAMPLE
+    =======
+
+    >>> assoc({'a': 1}, 'a', 2)
+    True
+
+    >>> assoc({'a': 1}, 'a', 1)
+    False
+
+    >>> assoc({}, 'a', None)
+    True
+
+    """
+
+    changed = key not in obj or obj[key] != value
+    obj[key] = value
+    return changed
+
+class JSONWriter(object):
+    """
+    writes a json document to a file from the events of its parsing, as
+    given by ijson, and the values inserted in between.
+    """
+
+    def __init__(self, out):
+
+        self.out = out
+
+        # for each container being written, whether it is still empty.
+        self.empty = [True]
+        self.after_key = False
+
+    def separator(self):
+        """
+        write the separator that comes before the next value.
+        """
+
+        if self.after_key:
+            self.after_key = False
+        elif self.empty[-1]:
+            self.empty[-1] = False
+        else:
+            self.out.write(',')
+
+        return
+
+    def event(self, event, value):
+        """
+        write the json for an ijson parsing event.
+        """
+
+        if event == 'start_map' or event == 'start_array':
+            self.separator()
+            self.out.write('{' if event == 'start_map' else '[')
+            self.empty.append(True)
+        elif event == 'end_map' or event == 'end_array':
+            self.empty.pop()
+            self.out.write('}' if event == 'end_map' else ']')
+        elif event == 'map_key':
+            self.separator()
+            self.out.write(json.dumps(value))
+            self.out.write(':')
+            self.after_key = True
+        else:
+            self.value(value)
+
+        return
+
+    def value(self, value):
+        """
+        write a whole json value.
+        """
+
+        self.separator()
+        self.out.write(json.dumps(value))
+        return
+
+class Metrics(object):
+    """
+    duration histograms and counters of the publication, exported in the
+    prometheus text format for the node exporter textfile collector. The
+    metrics gathered by a worker process are merged into the parent's with
+    snapshot and merge.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120, 300, 600, 1800, 3600)
+
+    descriptions = {
+            'publish_stage_duration_seconds':
+                'time spent in each publish operation.',
+            'publish_guide_duration_seconds':
+                'time spent on a guide by each publish operation.',
+            'publish_external_call_duration_seconds':
+                'time spent in calls to external services and tools.',
+            'publish_stage_guides_total':
+                'guides processed by each publish operation.',
+            'publish_stage_errors_total':
+                'publish operations that reported errors.',
+            'publish_events_total':
+                'events counted during the publication.',
+            'publish_last_update_timestamp_seconds':
+                'time at which the metrics were written.'
+            }
+
+    def __init__(self, slowest_size=10):
+
+        self.lock = threading.Lock()
+        self.slowest_size = slowest_size
+
+        # the stage currently running, the label of the guide durations.
+        self.stage = None
+        self.clear()
+
+    def clear(self):
+        """
+        forget all the metrics.
+        """
+
+        with self.lock:
+            self.histograms = {}
+            self.counts = collections.Counter()
+            self.slowest = {}
+
+        return
+
+    def observe(self, name, value, **labels):
+        """
+        add value to the histogram name with labels.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self.buckets), 0.0, 0]
+                self.histograms[key] = histogram
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+        return
+
+    def inc(self, name, value=1, **labels):
+        """
+        increment the counter name with labels.
+        """
+
+        with self.lock:
+            self.counts[(name, tuple(sorted(labels.items())))] += value
+
+        return
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """
+        observe the time spent in the with block in the histogram name.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def guides(self, guides, seconds):
+        """
+        record that the current stage spent seconds on the guides. The time
+        is shared equally between them.
+        """
+
+        if not guides:
+            return
+
+        seconds = seconds / len(guides)
+        for guide in guides:
+            self.observe('publish_guide_duration_seconds', seconds,
+                         stage=self.stage)
+
+        with self.lock:
+            slowest = self.slowest.setdefault(self.stage, [])
+            slowest.extend((seconds, guide) for guide in guides)
+            slowest.sort(reverse=True)
+            del slowest[self.slowest_size:]
+
+        return
+
+    def snapshot(self):
+        """
+        returns a copy of the metrics that can be sent to another process.
+        """
+
+        with self.lock:
+            return {
+                    'histograms': {k: [list(h[0]), h[1], h[2]] for k, h in
+                        self.histograms.items()},
+                    'counts': dict(self.counts),
+                    'slowest': {k: list(v) for k, v in self.slowest.items()}
+                    }
+
+    def merge(self, snapshot):
+        """
+        add the metrics of a snapshot to these.
+        """
+
+        with self.lock:
+            for key, (buckets, total, count) in snapshot['histograms'].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = [[0] * len(self.buckets), 0.0, 0]
+                    self.histograms[key] = histogram
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+            self.counts.update(snapshot['counts'])
+
+            for stage, guides in snapshot['slowest'].items():
+                slowest = self.slowest.setdefault(stage, [])
+                slowest.extend(tuple(g) for g in guides)
+                slowest.sort(reverse=True)
+                del slowest[self.slowest_size:]
+
+        return
+
+    def log_slowest(self):
+        """
+        log the guides on which each stage spent the most time.
+        """
+
+        with self.lock:
+            for stage, slowest in sorted(self.slowest.items()):
+                for seconds, guide in slowest:
+                    logging.info('{} spent {:.2f}s on {}'.format(stage,
+                        seconds, guide))
+
+        return
+
+    def text(self, events=None):
+        """
+        returns the metrics, along with the events counter, in the
+        prometheus text format.
+        """
+
+        counts = collections.Counter()
+        for name, value in (events or {}).items():
+            counts[('publish_events_total', (('event', name),))] += value
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counts.update(self.counts)
+
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if not name in declared:
+                declared.add(name)
+                lines.append('# HELP {} {}'.format(name,
+                    self.descriptions.get(name, name)))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            declare(name, 'histogram')
+            for bound, bucket in zip(self.buckets, buckets):
+                lines.append('{}_bucket{} {}'.format(name,
+                    metric_labels(labels + (('le', repr(float(bound))),)),
+                    bucket))
+            lines.append('{}_bucket{} {}'.format(name,
+                metric_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(name, metric_labels(labels),
+                repr(total)))
+            lines.append('{}_count{} {}'.format(name, metric_labels(labels),
+                count))
+
+        for (name, labels), value in sorted(counts.items()):
+            declare(name, 'counter')
+            lines.append('{}{} {}'.format(name, metric_labels(labels), value))
+
+        name = 'publish_last_update_timestamp_seconds'
+        declare(name, 'gauge')
+        lines.append('{} {}'.format(name, repr(time.time())))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, events=None):
+        """
+        atomically write the metrics into filename, see text.
+        """
+
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as metrics_file:
+                metrics_file.write(self.text(events))
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logging.error('could not write the metrics into {}: {}'.format(
+                filename, e))
+
+        return
+
+# the metrics of the publication in this process.
+metrics = Metrics()
+
+def reset_metrics_lock():
+    """
+    give the metrics a new lock in a forked worker. The metrics writer thread
+    of the parent may hold the lock at the time of the fork, and it does not
+    exist in the worker to release it.
+    """
+
+    metrics.lock = threading.Lock()
+    return
+
+os.register_at_fork(after_in_child=reset_metrics_lock)
+
+def metric_labels(labels):
+    """
+    returns the prometheus representation of the (name, value) labels.
+
+    EXAMPLE
+    =======
+
+    >>> metric_labels((('stage', 'iata'), ('le', '+Inf')))
+    '{stage="iata",le="+Inf"}'
+
+    >>> metric_labels(())
+    ''
+
+    """
+
+    if not labels:
+        return ''
+
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                                .replace('"', '\\"')
+                                                .replace('\n', '\\n'))
+               for name, value in labels]
+
+    return '{' + ','.join(escaped) + '}'
+
+def external_call(call):
+    """
+    returns a context manager timing a call to an external service or tool.
+    """
+
+    return metrics.time('publish_external_call_duration_seconds', call=call)
+
+class MetricsWriter(threading.Thread):
+    """
+    write the metrics into a file every interval seconds until stopped.
+    """
+
+    def __init__(self, filename, interval=60):
+
+        threading.Thread.__init__(self, daemon=True)
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+            metrics.write(self.filename, counters)
+
+    def stop(self):
+        """
+        stop the writer and write the final metrics.
+        """
+
+        self.stopped.set()
+        self.join()
+        metrics.write(self.filename, counters)
+        return
+
+class Profiler(object):
+    """
+    profile each stage of the publication with cProfile into a .pstats file
+    of directory. With memory, the allocations of the stages are traced
+    with tracemalloc as well and their top allocation sites are written
+    next to it. Only the main thread of the publishing process is profiled.
+    """
+
+    def __init__(self, directory, memory=False, top=25):
+
+        self.directory = directory
+        self.memory = memory
+        self.top = top
+        self.summary = []
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        profile the with block as the stage name.
+        """
+
+        filename = os.path.join(self.directory, name.replace(',', '+'))
+        if self.memory:
+            tracemalloc.start()
+
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.time() - start
+
+            profile.dump_stats(filename + '.pstats')
+            calls = pstats.Stats(profile).total_calls
+
+            peak = None
+            if self.memory:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                with open(filename + '.memory.txt', 'w') as memory_file:
+                    memory_file.write('peak traced memory: {:.1f} MB\n'.format(
+                        peak / 1e6))
+                    for stat in snapshot.statistics('lineno')[:self.top]:
+                        memory_file.write('{}\n'.format(stat))
+
+            # ru_maxrss is the peak of the whole process so far, not of the
+            # stage, and is in kilobytes on linux. The traced peak is the one
+            # of the stage.
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            children_rss = \
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            self.summary.append((name, elapsed, calls, peak, rss, children_rss))
+
+    def log_summary(self):
+        """
+        print and log the summary table of the profiled stages. The traced
+        memory peak is the one of each stage, the rss peaks are the ones of
+        the publishing process and of its workers since they started.
+        """
+
+        lines = ['{:<40} {:>10} {:>12} {:>16} {:>20} {:>20}'.format('stage',
+            'seconds', 'calls', 'stage peak MB', 'rss peak so far MB',
+            'workers rss peak MB')]
+        for name, elapsed, calls, peak, rss, children_rss in self.summary:
+            lines.append('{:<40} {:>10.2f} {:>12} {:>16} {:>20.1f} {:>20.1f}'\
+                    .format(name,
+                            elapsed,
+                            calls,
+                            '{:.1f}'.format(peak / 1e6) if peak else '-',
+                            rss / 1e6,
+                            children_rss / 1e6))
+
+        table = '\n'.join(lines)
+        print(table)
+        logging.info('profile of the publication, written in {}:\n{}'.format(
+            self.directory, table))
+        return
+
+class NailgunServer(object):
+    """
+    a nailgun server run from the nailgun jar at path and listening on
+    host:port. It is started with the jars it must have on its classpath
+    and is only restarted when it stops answering to its health check.
+    """
+
+    def __init__(self, path, host=None, port=None, timeout=30,
+            health_timeout=5):
+
+        default_host, default_port = nailgun_address()
+        self.path = path
+        self.host = host or default_host
+        self.port = port or default_port
+        self.timeout = timeout
+        self.health_timeout = health_timeout
+        self.process = None
+
+        # the jars wanted on the classpath, and the ones the running server
+        # is known to have.
+        self.jars = []
+        self.loaded = set()
+
+    def healthy(self):
+        """
+        returns True if the server answers to ng-version within
+        health_timeout seconds. A hung server is not healthy.
+        """
+
+        try:
+            nailgun_call('ng-version', [], self.host, self.port,
+                         self.health_timeout)
+            return True
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return False
+
+    def ensure(self, jars=()):
+        """
+        make sure the server is running and healthy with the jars on its
+        classpath, starting or restarting it if needed. Returns True if it
+        could not be done.
+        """
+
+        for jar in jars:
+            if not jar in self.jars:
+                self.jars.append(jar)
+
+        if not self.healthy():
+            if self.process:
+                logging.error('nailgun on {}:{} is not answering, restarting'\
+                        ' it'.format(self.host, self.port))
+                self.stop()
+
+            if self.start():
+                return True
+
+        missing = [j for j in self.jars if not j in self.loaded]
+        if missing:
+            try:
+                nailgun_call('ng-cp', missing, self.host, self.port,
+                             self.health_timeout)
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                logging.critical('could not add {0} to the nailgun'\
+                        ' classpath: {1}'.format(missing, e))
+                return True
+
+            self.loaded.update(missing)
+            logging.info('added {} to the classpath of nailgun on'\
+                    ' {}:{}'.format(missing, self.host, self.port))
+
+        return False
+
+    def start(self):
+        """
+        start the server and wait until it answers. Returns True if it did
+        not within timeout seconds.
+        """
+
+        logging.info('starting nailgun on {}:{}'.format(self.host, self.port))
+        self.loaded = set()
+        try:
+            self.process = subprocess.Popen(
+                    ['java', '-jar', self.path,
+                        '{}:{}'.format(self.host, self.port)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True)
+        except OSError as e:
+            logging.critical('could not start nailgun: {}'.format(e))
+            return True
+
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                logging.critical('nailgun exited with status {}'.format(
+                    self.process.returncode))
+                self.process = None
+                return True
+
+            if self.healthy():
+                logging.info('nailgun is ready on {}:{}'.format(self.host,
+                    self.port))
+                return False
+
+            sleep(0.1)
+
+        logging.critical('nailgun did not answer on {}:{} within {}s'.format(
+            self.host, self.port, self.timeout))
+        self.stop()
+        return True
+
+    def stop(self):
+        """
+        stop the server.
+        """
+
+        try:
+            nailgun_call('ng-stop', [], self.host, self.port,
+                         self.health_timeout)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            pass
+
+        if self.process:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        self.process = None
+        self.loaded = set()
+        return
+
+class NailgunPool(object):
+    """
+    size nailgun servers listening on consecutive ports from port. Every
+    call goes to the server with the fewest calls in flight. A server that
+    refuses or drops a call is restarted and the call is retried on another
+    one.
+    """
+
+    def __init__(self, path, size=1, host=None, port=None, timeout=30):
+
+        default_host, default_port = nailgun_address()
+        host = host or default_host
+        port = port or default_port
+
+        self.servers = [NailgunServer(path, host, port + i, timeout)
+                        for i in range(size)]
+        self.outstanding = [0] * size
+        self.up = [False] * size
+        self.lock = threading.Lock()
+        self.restart_locks = [threading.Lock() for s in self.servers]
+
+    def ensure(self, jars=()):
+        """
+        make sure all the servers are running and healthy with the jars on
+        their classpath, starting them side by side. Returns True if none of
+        them is.
+        """
+
+        with ThreadPoolExecutor(max_workers=len(self.servers)) as executor:
+            errors = list(executor.map(lambda s: s.ensure(jars), self.servers))
+
+        with self.lock:
+            self.up = [not e for e in errors]
+
+        return not any(self.up)
+
+    def call(self, command, args, retries=1):
+        """
+        run command with args on the least busy server. See nailgun_call.
+        """
+
+        with self.lock:
+            available = [i for i, up in enumerate(self.up) if up]
+            if not available:
+                raise ConnectionError('no nailgun server is available')
+            i = min(available, key=lambda i: self.outstanding[i])
+            self.outstanding[i] += 1
+
+        server = self.servers[i]
+        try:
+            return nailgun_call(command, args, server.host, server.port)
+        except (ConnectionRefusedError, ConnectionResetError) as e:
+            # only a server that is gone is restarted, a slow call is not
+            # a reason for it.
+            error = e
+        finally:
+            with self.lock:
+                self.outstanding[i] -= 1
+
+        logging.error('nailgun on {}:{} failed to run {}: {}'.format(
+            server.host, server.port, command, error))
+        self.recover(i)
+
+        if retries > 0:
+            return self.call(command, args, retries - 1)
+
+        raise error
+
+    def recover(self, i):
+        """
+        restart the i-th server if it is not healthy. It gets no call until
+        it is.
+        """
+
+        with self.restart_locks[i]:
+            with self.lock:
+                self.up[i] = False
+
+            up = not self.servers[i].ensure()
+            with self.lock:
+                self.up[i] = up
+
+        return
+
+    def stop(self):
+        """
+        stop all the servers.
+        """
+
+        for server in self.servers:
+            server.stop()
+
+        return
+
+class Journal(object):
+    """
+    an append only record of the guides completed by each stage of a run.
+    Every record is written out before the stage moves on so that a run that
+    was killed can be resumed where it stopped. They are synced to disk, for
+    a crash of the system, at most every sync_interval seconds and at the end
+    of each stage.
+    """
+
+    def __init__(self, filename, resume=False, sync_interval=1.0):
+
+        self.filename = filename
+        self.stages = []
+        self.completed = set()
+        self.sync_interval = sync_interval
+        self.synced = time.time()
+
+        size = 0
+        if resume:
+            try:
+                with open(filename, 'r', encoding='utf-8') as journal:
+                    for line in journal:
+                        # the last line may have been cut short by the crash.
+                        if not line.endswith('\n'):
+                            break
+                        stage, guide = line.rstrip('\n').split('\t', 1)
+                        self.completed.add((stage, guide))
+                        size += len(line.encode('utf-8'))
+            except FileNotFoundError:
+                pass
+
+        self.journal = open(filename, 'a' if resume else 'w', encoding='utf-8')
+
+        # drop what is left of a record cut short before appending to it.
+        self.journal.truncate(size)
+
+    def is_completed(self, stages, guide):
+        """
+        returns True if all the stages were completed for the guide.
+        """
+
+        return all((s, guide) in self.completed for s in stages)
+
+    def record(self, guides):
+        """
+        record that the current stages were completed for the guides.
+        """
+
+        for guide in guides:
+            for stage in self.stages:
+                self.journal.write('{}\t{}\n'.format(stage, guide))
+                self.completed.add((stage, guide))
+
+        self.journal.flush()
+        if time.time() - self.synced >= self.sync_interval:
+            self.sync()
+
+        return
+
+    def sync(self):
+        """
+        sync the records to disk.
+        """
+
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.synced = time.time()
+        return
+
+    def close(self, remove=False):
+        """
+        close the journal. It is removed once the run is over.
+        """
+
+        self.journal.close()
+        if remove:
+            os.remove(self.filename)
+        return
+
+class Cache(object):
+    """
+    persistent key/value cache stored in a sqlite file. Entries older than
+    ttl seconds are expired and, past max_entries, the least recently used
+    entries are evicted. Values must be json serializable. The cache can be
+    shared between threads.
+    """
+
+    def __init__(self, filename, ttl=None, max_entries=None):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(filename,
+                                  timeout=60,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('create table if not exists cache'\
+                ' (key text primary key, value text, created real, used real)')
+        self.db.execute('create index if not exists cache_used on cache (used)')
+        # the keys memoized for each guide are kept apart from the cached
+        # values so that they are neither expired nor evicted with them.
+        self.db.execute('create table if not exists guide_keys'\
+                ' (guide text, key text, primary key (guide, key))')
+
+        if ttl:
+            self.db.execute('delete from cache where created < ?',
+                            (time.time() - ttl,))
+
+        self.size = self.db.execute('select count(*) from cache').fetchone()[0]
+
+    def get(self, key):
+        """
+        returns the value cached for key, None if there is none.
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('select value, created from cache'\
+                    ' where key = ?', (key,)).fetchone()
+
+            if not row or (self.ttl and row[1] < now - self.ttl):
+                self.misses += 1
+                return None
+
+            self.db.execute('update cache set used = ? where key = ?',
+                            (now, key))
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        cache value for key.
+        """
+
+        now = time.time()
+        with self.lock:
+            known = self.db.execute('select 1 from cache where key = ?',
+                                    (key,)).fetchone()
+            self.db.execute('insert or replace into cache values (?,?,?,?)',
+                            (key, json.dumps(value), now, now))
+            if not known:
+                self.size += 1
+
+            if self.max_entries and self.size > self.max_entries:
+                self.evict()
+
+        return
+
+    def delete(self, key):
+        """
+        remove the value cached for key.
+        """
+
+        with self.lock:
+            self.db.execute('delete from cache where key = ?', (key,))
+            self.size = self.db.execute('select count(*) from cache').fetchone()[0]
+
+        return
+
+    def evict(self):
+        """
+        remove the least recently used entries beyond max_entries.
+        """
+
+        # other processes may be using the same file, so recount.
+        self.size = self.db.execute('select count(*) from cache').fetchone()[0]
+        excess = self.size - self.max_entries
+        if excess > 0:
+            self.db.execute('delete from cache where key in'\
+                    ' (select key from cache order by used limit ?)', (excess,))
+            self.size -= excess
+
+        return
+
+    def tag(self, guide, key):
+        """
+        record that the value cached for key belongs to guide.
+        """
+
+        with self.lock:
+            self.db.execute('insert or ignore into guide_keys values (?,?)',
+                            (guide, key))
+
+        return
+
+    def tagged(self, guide):
+        """
+        returns the keys recorded for guide.
+        """
+
+        with self.lock:
+            rows = self.db.execute('select key from guide_keys'\
+                    ' where guide = ?', (guide,)).fetchall()
+
+        return [r[0] for r in rows]
+
+    def untag(self, guide):
+        """
+        forget the keys recorded for guide.
+        """
+
+        with self.lock:
+            self.db.execute('delete from guide_keys where guide = ?', (guide,))
+
+        return
+
+    def stats(self):
+        """
+        returns a summary of the hits and misses of the cache.
+        """
+
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return '{} hits, {} misses ({:.1f}% hit rate) on {}'.format(
+                self.hits, self.misses, rate, self.filename)
+
+    def close(self):
+        self.db.close()
+        return
+
+class OfflineGeocoder(object):
+    """
+    reverse geocoder answering from a local address dataset held in memory.
+
+    The dataset is a csv file with a header. Its latitude and longitude
+    columns locate each address and its other columns are the fields of the
+    parsed address, as returned by reversegeo. Nearest neighbours are found
+    with a scipy KD-tree when scipy is installed, and with a grid of cells
+    of cell degrees otherwise. Addresses farther than max_distance meters
+    are not considered.
+    """
+
+    earth_radius = 6371000.0
+
+    def __init__(self, filename, max_distance=1000, cell=0.01):
+        self.filename = filename
+        self.max_distance = max_distance
+        self.cell = cell
+
+        self.addresses = []
+        self.points = []
+        with open(filename, 'r', newline='', encoding='utf-8') as data:
+            reader = csv.DictReader(data)
+            if not {'latitude', 'longitude'} <= set(reader.fieldnames or ()):
+                raise ValueError('the geocoder data {} has no latitude and'\
+                        ' longitude columns'.format(filename))
+
+            for row in reader:
+                latitude = float(row.pop('latitude'))
+                longitude = float(row.pop('longitude'))
+                self.points.append(unit_vector(latitude, longitude))
+                self.addresses.append(
+                        {k: v for k, v in row.items() if v != ''})
+
+        if not self.points:
+            raise ValueError('the geocoder data {} has no addresses'.format(
+                filename))
+
+        # the straight line distance, on the unit sphere, that corresponds to
+        # max_distance along the surface.
+        self.max_chord = 2 * math.sin(max_distance / (2 * self.earth_radius))
+
+        # the number of cells around a parallel of the grid.
+        self.lon_cells = int(math.ceil(360 / cell))
+
+        self.tree = None
+        self.grid = None
+        if cKDTree is not None:
+            self.tree = cKDTree(self.points)
+        else:
+            self.grid = collections.defaultdict(list)
+            for i, (x, y, z) in enumerate(self.points):
+                latitude, longitude = lat_lon(x, y, z)
+                self.grid[self.cell_of(latitude, longitude)].append(i)
+
+        logging.info('loaded {} addresses from {}'.format(
+            len(self.addresses), filename))
+
+    def cell_of(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell)),
+                int(math.floor((longitude % 360) / self.cell)))
+
+    def reverse_geocode(self, coordinates):
+        """
+        returns the parsed address of the closest entry to each of the
+        (latitude, longitude) coordinates, None where there is none within
+        max_distance.
+        """
+
+        if not coordinates:
+            return []
+
+        points = [unit_vector(lat, lon) for lat, lon in coordinates]
+
+        if self.tree is not None:
+            distances, indexes = self.tree.query(
+                    points, distance_upper_bound=self.max_chord)
+            return [self.addresses[i] if i < len(self.addresses) else None
+                    for i in indexes]
+
+        return [self.nearest(lat, lon, point)
+                for (lat, lon), point in zip(coordinates, points)]
+
+    def nearest(self, latitude, longitude, point):
+        """
+        returns the parsed address of the grid entry closest to point.
+        """
+
+        # the cells to look into to cover max_distance around the point.
+        span = math.degrees(self.max_distance / self.earth_radius)
+        lon_span = span / max(math.cos(math.radians(latitude)), 1e-6)
+        min_lat = int(math.floor((latitude - span) / self.cell))
+        max_lat = int(math.floor((latitude + span) / self.cell))
+        min_lon = int(math.floor((longitude - lon_span) / self.cell))
+        max_lon = int(math.floor((longitude + lon_span) / self.cell))
+
+        # the cells wrap around at the antimeridian.
+        if max_lon - min_lon + 1 >= self.lon_cells:
+            columns = range(self.lon_cells)
+        else:
+            columns = {j % self.lon_cells for j in range(min_lon, max_lon + 1)}
+
+        best = None
+        best_chord = self.max_chord
+        for i in range(min_lat, max_lat + 1):
+            for j in columns:
+                for k in self.grid.get((i, j), ()):
+                    chord = math.sqrt(sum((a - b) ** 2 for a, b in
+                        zip(point, self.points[k])))
+                    if chord <= best_chord:
+                        best = k
+                        best_chord = chord
+
+        return self.addresses[best] if best is not None else None
+
+def unit_vector(latitude, longitude):
+    """
+    returns the point of the unit sphere at latitude, longitude.
+    """
+
+    phi = math.radians(latitude)
+    theta = math.radians(longitude)
+
+    return (math.cos(phi) * math.cos(theta),
+            math.cos(phi) * math.sin(theta),
+            math.sin(phi))
+
+def lat_lon(x, y, z):
+    """
+    returns the latitude and longitude of a point of the unit sphere.
+    """
+
+    return (math.degrees(math.asin(max(-1.0, min(1.0, z)))),
+            math.degrees(math.atan2(y, x)))
+
 def get_in(obj, *keys):
     for k in keys:
         v = obj.get(k, None)
@@ -1419,6 +4571,8 @@ def unquote(uri):
     if uri[0] == '"' and uri[-1] == '"':
         return uri[1:-1]
 
+    return uri
+
 if __name__ == '__main__':
     main()
 
@@ -1,20 +1,67 @@
 #!/usr/bin/env python3
 
+import collections
 import json
 import mtriputils
 import os
+import random
+import requests
 import shutil
-
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from nose import with_setup
 
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 
+from publish import Cache
+from publish import Journal
+from publish import Metrics
+from publish import Profiler
+from publish import OfflineGeocoder
 from publish import categories
+from publish import city_name_translation
+from publish import close_process_connections
+from publish import db_cursor
+from publish import db_execute
+from publish import db_pools
+from publish import db_timings
 from publish import descriptions_url
+from publish import description_publish
+from publish import description_sources
+from publish import download
+from publish import download_to_zip
 from publish import must_remove_attraction
+from publish import file_hash
+from publish import invalidate_guide
+from publish import json_codecs
+from publish import list_guide
+from publish import memoize
+from publish import merge_db_timings
+from publish import metrics
+from publish import NailgunPool
+from publish import NailgunServer
+from publish import nailgun_call
+from publish import nailgunstop
+from publish import outdated_guides
+from publish import pipeline_publish
+from publish import update_manifest
 from publish import archive_filename
 from publish import remove_from_zip
 from publish import remove_street_picture
+from publish import remove_homepage_from_domains
+from publish import filter_poi
+from publish import iata_codes
+from publish import http_session
+from publish import transform_guide
+from publish import url_filename
 
 
 test_guide_filename = '/root/dev/publish/test-guides/Lisbon-test/result.json'
@@ -112,6 +159,22 @@ def test_descriptions_url():
     return
 
 
+def test_description_sources():
+
+    poi = {"name": {"name": "Montreal"},
+           "descriptions": {
+               "en": {"source": {"url": "http://en.wikipedia.org/wiki/Montreal"}},
+               "es": {"source": {"url": "http://en.wikivoyage.org/wiki/Montreal"}},
+               "fr": {"source": {"url": "http://facebook.com/montreal"}}}}
+
+    result = description_sources([poi])
+
+    urls = sorted(url for p, v, url in result)
+    assert urls == ['http://en.wikipedia.org/wiki/Montreal',
+                    'http://en.wikivoyage.org/wiki/Montreal']
+    return
+
+
 def test_must_remove_attraction():
 
     poi = {
@@ -318,3 +381,1199 @@ def test_remove_street_name():
 
     assert not has_street_pic(guides)
     return
+
+def test_transform_guide_setup():
+
+    test_dir = '/tmp/test_transform'
+    os.makedirs(test_dir, exist_ok = True)
+
+    with open(os.path.join(test_dir, 'result.json'), 'w') as guide:
+        json.dump({"Cities": [{"pois": []}]}, guide)
+
+    return
+
+def test_transform_guide_teardown():
+
+    test_dir = '/tmp/test_transform'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_transform_guide_setup, test_transform_guide_teardown)
+def test_transform_guide():
+    """
+    the transforms are chained and the guide is only written when changed.
+    """
+
+    guide_name = '/tmp/test_transform/result.json'
+
+    def unchanged(guide, content):
+        return False, False
+
+    def add_alpha2(guide, content):
+        content['Cities'][0]['alpha2'] = 'CA'
+        return True, False
+
+    os.utime(guide_name, (0, 0))
+    error = transform_guide(guide_name, [unchanged])
+    assert not error
+    assert os.path.getmtime(guide_name) == 0
+
+    error = transform_guide(guide_name, [unchanged, add_alpha2])
+    assert not error
+
+    with open(guide_name, 'r') as guide:
+        content = json.load(guide)
+
+    assert content['Cities'][0]['alpha2'] == 'CA'
+    return
+
+def test_cache_setup():
+
+    test_dir = '/tmp/test_cache'
+    os.makedirs(test_dir, exist_ok = True)
+    return
+
+def test_cache_teardown():
+
+    test_dir = '/tmp/test_cache'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_cache_setup, test_cache_teardown)
+def test_cache():
+    """
+    cached values survive reopening and the least recently used are evicted.
+    """
+
+    cache_name = '/tmp/test_cache/cache.sqlite'
+
+    cache = Cache(cache_name, max_entries = 2)
+    cache.put('a', {'article': 'a'})
+    cache.put('b', {'article': 'b'})
+    cache.close()
+
+    cache = Cache(cache_name, max_entries = 2)
+    assert cache.get('a') == {'article': 'a'}
+
+    # b is now the least recently used entry.
+    cache.put('c', {'article': 'c'})
+
+    assert cache.get('b') is None
+    assert cache.get('c') == {'article': 'c'}
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+    cache.close()
+    return
+
+@with_setup(test_cache_setup, test_cache_teardown)
+def test_invalidate_guide():
+    """
+    the values memoized for a guide are invalidated even after evictions,
+    including the ones it took from the cache.
+    """
+
+    cache = Cache('/tmp/test_cache/cache.sqlite', max_entries = 2)
+    guide_1 = '/tmp/test_cache/city-1/result.json'
+    guide_2 = '/tmp/test_cache/city-2/result.json'
+
+    memoize(cache, guide_1, 'a', lambda: 'value a')
+    memoize(cache, guide_1, 'b', lambda: 'value b')
+    memoize(cache, guide_2, 'a', lambda: 'value a')
+    memoize(cache, guide_2, 'c', lambda: 'value c')
+
+    invalidate_guide(cache, 2)
+
+    assert cache.get('a') is None
+    assert cache.get('c') is None
+    assert sorted(cache.tagged('1')) == ['a', 'b']
+    assert cache.tagged('2') == []
+
+    cache.close()
+    return
+
+def test_offline_geocoder_setup():
+
+    test_dir = '/tmp/test_geocoder'
+    os.makedirs(test_dir, exist_ok = True)
+
+    with open(os.path.join(test_dir, 'addresses.csv'), 'w') as addresses:
+        addresses.write('latitude,longitude,street,city\n')
+        addresses.write('45.5017,-73.5673,rue Sainte-Catherine,Montreal\n')
+        addresses.write('45.5088,-73.5542,rue Notre-Dame,Montreal\n')
+        addresses.write('-16.8,179.9995,Naqara Road,Taveuni\n')
+
+    with open(os.path.join(test_dir, 'empty.csv'), 'w') as addresses:
+        addresses.write('latitude,longitude,street,city\n')
+
+    with open(os.path.join(test_dir, 'columns.csv'), 'w') as addresses:
+        addresses.write('lat,lon,street,city\n')
+        addresses.write('45.5017,-73.5673,rue Sainte-Catherine,Montreal\n')
+
+    return
+
+def test_offline_geocoder_teardown():
+
+    test_dir = '/tmp/test_geocoder'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_offline_geocoder_setup, test_offline_geocoder_teardown)
+def test_offline_geocoder():
+    """
+    must answer the closest address, across the antimeridian too, and
+    nothing when too far from all.
+    """
+
+    geocoder = OfflineGeocoder('/tmp/test_geocoder/addresses.csv')
+
+    result = geocoder.reverse_geocode([(45.5086, -73.5545), (48.85, 2.35),
+        (-16.8, -179.9995)])
+
+    assert result[0] == {'street': 'rue Notre-Dame', 'city': 'Montreal'}
+    assert result[1] is None
+    assert result[2] == {'street': 'Naqara Road', 'city': 'Taveuni'}
+
+    for data in ['empty.csv', 'columns.csv']:
+        try:
+            OfflineGeocoder(os.path.join('/tmp/test_geocoder', data))
+            assert False
+        except ValueError:
+            pass
+
+    return
+
+def test_manifest_setup():
+
+    test_dir = '/tmp/test_manifest'
+    for d in ['a', 'b']:
+        os.makedirs(os.path.join(test_dir, d), exist_ok = True)
+        with open(os.path.join(test_dir, d, 'guide.json'), 'w') as g:
+            json.dump({'Cities': [{'name': d}]}, g)
+
+    return
+
+def test_manifest_teardown():
+
+    test_dir = '/tmp/test_manifest'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_manifest_setup, test_manifest_teardown)
+def test_manifest():
+    """
+    a stage is outdated for a guide after its content or the stage
+    parameters changed, and after the stage failed.
+    """
+
+    path = '/tmp/test_manifest'
+    guides = [os.path.join(path, d, 'guide.json') for d in ['a', 'b']]
+    params = {'homepage-remove': ['facebook']}
+    hashes = {g: file_hash(g) for g in guides}
+
+    manifest = {}
+    ran = [(['homepage-remove'], guides, False), (['iso3166'], guides, True)]
+    update_manifest(manifest, path, guides, hashes, ran, params)
+
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['homepage-remove'], params) == []
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['iso3166'], params) == guides
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['homepage-remove'], {'homepage-remove': ['yelp']}) == guides
+
+    with open(guides[1], 'w') as g:
+        json.dump({'Cities': [{'name': 'c'}]}, g)
+
+    hashes = {g: file_hash(g) for g in guides}
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['homepage-remove'], params) == [guides[1]]
+
+    # only the stages that ran on the new content are up to date for it.
+    update_manifest(manifest, path, guides, hashes,
+            [(['categories'], [guides[1]], False)], params)
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['categories'], params) == [guides[0]]
+    assert outdated_guides(manifest, path, guides, hashes,
+            ['homepage-remove'], params) == [guides[1]]
+    return
+
+def test_journal_setup():
+
+    test_dir = '/tmp/test_journal'
+    os.makedirs(test_dir, exist_ok = True)
+    return
+
+def test_journal_teardown():
+
+    test_dir = '/tmp/test_journal'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_journal_setup, test_journal_teardown)
+def test_journal():
+    """
+    a resumed journal must know about the guides completed by the previous
+    run, and nothing about a record cut short.
+    """
+
+    journal_name = '/tmp/test_journal/journal'
+
+    journal = Journal(journal_name)
+    journal.stages = ['categories', 'iso3166']
+    journal.record(['a/guide.json'])
+    journal.close()
+
+    with open(journal_name, 'a') as j:
+        j.write('categories\tb/gui')
+
+    journal = Journal(journal_name, resume = True)
+    assert journal.is_completed(['categories', 'iso3166'], 'a/guide.json')
+    assert not journal.is_completed(['categories'], 'b/gui')
+
+    journal.stages = ['categories']
+    journal.record(['b/guide.json'])
+    journal.close()
+
+    journal = Journal(journal_name, resume = True)
+    assert journal.is_completed(['categories'], 'b/guide.json')
+    journal.close(remove = True)
+
+    assert not os.path.exists(journal_name)
+    return
+
+def test_json_codecs():
+    """
+    every codec must give back the guide content with its keys in order,
+    and dump it as ascii.
+    """
+
+    content = {'Id': 1, 'Cities': [{'pois': [], 'name': 'Montréal',
+        'country': 'Canada', 'note': 'Sous-titré 日本語 😀'}]}
+    data = json.dumps(content, ensure_ascii = False).encode('utf-8')
+
+    for name, (loads, dumps) in json_codecs().items():
+        loaded = loads(data)
+        assert list(loaded['Cities'][0]) == ['pois', 'name', 'country', 'note']
+        dumped = dumps(loaded)
+        assert json.loads(dumped.decode('ascii')) == content
+        assert loads(dumped) == content
+
+    return
+
+def test_stream_guide_setup():
+
+    test_dir = '/tmp/test_stream_guide'
+    pois = [{'name': {'name': 'Tour Eiffel', 'lang': 'fr'},
+             'homepage': {'homepage': 'http://www.facebook.com/eiffel'},
+             'location': {'latitude': 48.8584, 'longitude': 2.2945},
+             'address': {'street': 'Champ-de-Mars, 7ème arrondissement'}},
+            {'name': {'name': 'Louvre'},
+             'homepage': {'homepage': 'http://www.louvre.fr/'},
+             'descriptions': [], 'rank': None, 'open': True}]
+
+    for d in ['memory', 'stream']:
+        os.makedirs(os.path.join(test_dir, d), exist_ok = True)
+        with open(os.path.join(test_dir, d, 'guide.json'), 'w') as g:
+            json.dump({'Id': 7, 'Cities': [{'name': 'Paris', 'pois': pois}]}, g)
+        with open(os.path.join(test_dir, d, 'nopois.json'), 'w') as g:
+            json.dump({'Id': 8, 'Cities': [{'name': 'Lyon'}]}, g)
+
+    return
+
+def test_stream_guide_teardown():
+
+    test_dir = '/tmp/test_stream_guide'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_stream_guide_setup, test_stream_guide_teardown)
+def test_stream_guide():
+    """
+    streaming the pois through a stage must give the same guide as loading
+    it in memory.
+    """
+
+    test_dir = '/tmp/test_stream_guide'
+    memory = os.path.join(test_dir, 'memory', 'guide.json')
+    stream = os.path.join(test_dir, 'stream', 'guide.json')
+
+    assert not remove_homepage_from_domains([memory], ['facebook'])
+    assert not remove_homepage_from_domains([stream], ['facebook'],
+            stream = True)
+
+    assert not filter_poi([memory], lambda p: p['name']['name'] == 'Louvre')
+    assert not filter_poi([stream], lambda p: p['name']['name'] == 'Louvre',
+            stream = True)
+
+    with open(memory, encoding = 'ascii') as m, \
+            open(stream, encoding = 'ascii') as s:
+        streamed = json.load(s)
+        assert json.load(m) == streamed
+
+    assert streamed['Cities'][0]['pois'][0]['homepage']['homepage'] is None
+    assert len(streamed['Cities'][0]['pois']) == 1
+
+    # a guide without pois is an error either way.
+    assert remove_homepage_from_domains(
+            [os.path.join(test_dir, 'memory', 'nopois.json')], ['facebook'])
+    assert remove_homepage_from_domains(
+            [os.path.join(test_dir, 'stream', 'nopois.json')], ['facebook'],
+            stream = True)
+    return
+
+def test_list_guide_setup():
+
+    test_dir = '/tmp/test_list_guide'
+    for d in ['paris-1', 'rome-2', 'empty']:
+        os.makedirs(os.path.join(test_dir, d), exist_ok = True)
+
+    for d in ['paris-1', 'rome-2']:
+        with open(os.path.join(test_dir, d, 'result.json'), 'w') as g:
+            g.write('{}')
+
+    # old enough for the index to trust them.
+    for d in ['paris-1', 'rome-2', 'empty', '']:
+        os.utime(os.path.join(test_dir, d), (0, 0))
+
+    return
+
+def test_list_guide_teardown():
+
+    test_dir = '/tmp/test_list_guide'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_list_guide_setup, test_list_guide_teardown)
+def test_list_guide():
+    """
+    the guide index must only be trusted for unmodified directories.
+    """
+
+    test_dir = '/tmp/test_list_guide'
+    expected = [os.path.join(test_dir, d, 'result.json')
+                for d in ['paris-1', 'rome-2']]
+
+    assert sorted(list_guide(test_dir, 'result.json')) == expected
+    assert sorted(list_guide(test_dir, 'result.json', index = True,
+        workers = 2)) == expected
+    assert sorted(list_guide(test_dir, 'result.json', index = True)) == expected
+
+    with open(os.path.join(test_dir, 'empty', 'result.json'), 'w') as g:
+        g.write('{}')
+
+    guides = list_guide(test_dir, 'result.json', index = True)
+    assert os.path.join(test_dir, 'empty', 'result.json') in guides
+    return
+
+def test_metrics():
+    """
+    the metrics of a worker must add up with the parent's in the exported
+    histograms.
+    """
+
+    parent = Metrics()
+    worker = Metrics()
+
+    parent.observe('publish_stage_duration_seconds', 0.2, stage = 'iata')
+    worker.observe('publish_stage_duration_seconds', 20, stage = 'iata')
+    worker.stage = 'iata'
+    worker.guides(['a/result.json', 'b/result.json'], 3)
+
+    parent.merge(worker.snapshot())
+    text = parent.text({'reversegeo cache hits': 2})
+
+    assert 'publish_stage_duration_seconds_bucket{stage="iata",le="0.25"} 1' in text
+    assert 'publish_stage_duration_seconds_bucket{stage="iata",le="+Inf"} 2' in text
+    assert 'publish_stage_duration_seconds_sum{stage="iata"} 20.2' in text
+    assert 'publish_guide_duration_seconds_count{stage="iata"} 2' in text
+    assert 'publish_events_total{event="reversegeo cache hits"} 2' in text
+    assert parent.slowest['iata'][0] == (1.5, 'b/result.json')
+    return
+
+def test_metrics_fork():
+    """
+    a worker forked while the metrics lock is held must still be able to
+    use the metrics.
+    """
+
+    with metrics.lock:
+        pid = os.fork()
+        if pid == 0:
+            metrics.clear()
+            os._exit(0)
+
+    deadline = time.time() + 10
+    status = None
+    while status is None and time.time() < deadline:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if not done:
+            status = None
+            time.sleep(0.05)
+
+    if status is None:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    assert status == 0
+    return
+
+def test_profiler_setup():
+
+    test_dir = '/tmp/test_profiler'
+    os.makedirs(test_dir, exist_ok = True)
+    return
+
+def test_profiler_teardown():
+
+    test_dir = '/tmp/test_profiler'
+    shutil.rmtree(test_dir)
+    return
+
+@with_setup(test_profiler_setup, test_profiler_teardown)
+def test_profiler():
+    """
+    every profiled stage must have its profile and memory report.
+    """
+
+    test_dir = '/tmp/test_profiler'
+    profiler = Profiler(test_dir, memory = True)
+
+    with profiler.stage('categories,iso3166'):
+        sorted(str(i) for i in range(1000))
+
+    assert os.path.exists(os.path.join(test_dir, 'categories+iso3166.pstats'))
+    assert os.path.exists(os.path.join(test_dir,
+        'categories+iso3166.memory.txt'))
+    assert profiler.summary[0][0] == 'categories,iso3166'
+    return
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    """
+    answers the content its server has for the path, a 404 otherwise. The
+    path, user agent and client port of every request are kept in the
+    requests of the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path,
+            self.headers.get('User-Agent'), self.client_address[1]))
+        content = self.server.contents.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+def start_http_server(contents):
+    """
+    returns a local http server answering the contents by path.
+    """
+
+    server = HTTPServer(('127.0.0.1', 0), FakeHTTPHandler)
+    server.contents = contents
+    server.requests = []
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+http_server = None
+
+def test_download_to_zip_setup():
+
+    global http_server
+    http_server = start_http_server({'/pics/banner.jpg': b'banner' * 1000,
+                                     '/pics/': b'index'})
+    os.makedirs('/tmp/test_download_to_zip', exist_ok = True)
+    return
+
+def test_download_to_zip_teardown():
+
+    http_server.shutdown()
+    http_server.server_close()
+    shutil.rmtree('/tmp/test_download_to_zip', ignore_errors = True)
+    return
+
+@with_setup(test_download_to_zip_setup, test_download_to_zip_teardown)
+def test_download():
+    """
+    the banners must be downloaded on the connection kept alive by the
+    session, with its user agent, and a failed download is an error.
+    """
+
+    folder = '/tmp/test_download_to_zip'
+    session = http_session('publish-test', 2)
+
+    url = http_server.url + '/pics/banner.jpg'
+    for i in range(3):
+        assert not download(session, folder, 'banner.jpg', url)
+    assert download(session, folder, 'missing.jpg',
+            http_server.url + '/pics/missing.jpg')
+
+    with open(os.path.join(folder, 'banner.jpg'), 'rb') as banner:
+        assert banner.read() == b'banner' * 1000
+    assert not os.path.exists(os.path.join(folder, 'missing.jpg'))
+
+    assert [r[1] for r in http_server.requests] == ['publish-test'] * 4
+    assert len(set(r[2] for r in http_server.requests)) == 1
+
+    session.close()
+    return
+
+@with_setup(test_download_to_zip_setup, test_download_to_zip_teardown)
+def test_download_to_zip():
+    """
+    the banner must end up in pics.zip, and a failed download or a url
+    without a filename must be an error that leaves pics.zip untouched.
+    """
+
+    folder = '/tmp/test_download_to_zip'
+    session = requests.Session()
+
+    url = http_server.url + '/pics/banner.jpg'
+    assert not download_to_zip(session, folder, url_filename(url), url)
+
+    missing = http_server.url + '/pics/missing.jpg'
+    assert download_to_zip(session, folder, url_filename(missing), missing)
+
+    no_filename = http_server.url + '/pics/'
+    assert download_to_zip(session, folder, url_filename(no_filename),
+            no_filename)
+
+    with ZipFile(os.path.join(folder, 'pics.zip')) as z:
+        assert z.namelist() == ['banner.jpg']
+        assert z.read('banner.jpg') == b'banner' * 1000
+
+    # already in pics.zip, it is not downloaded again.
+    http_server.contents.clear()
+    assert not download_to_zip(session, folder, url_filename(url), url)
+
+    session.close()
+    return
+
+class FakeNailgunHandler(socketserver.BaseRequestHandler):
+    """
+    answers a nailgun client. ng-version, ng-cp and ng-stop succeed, echo
+    asks for stdin then writes its arguments on stdout, fail exits with 3,
+    sleep waits for its argument in seconds and hang never answers. Any
+    other command is a description generator answering an article for each
+    of its url arguments, after the delay of the server, and failing on the
+    urls with broken in them. The commands run are kept in the calls of the
+    server. A hung server never answers at all.
+    """
+
+    def recv(self, size):
+        data = b''
+        while len(data) < size:
+            part = self.request.recv(size - len(data))
+            if not part:
+                raise EOFError()
+            data += part
+        return data
+
+    def recv_chunk(self):
+        length, chunk_type = struct.unpack('>Ic', self.recv(5))
+        return chunk_type, self.recv(length).decode('utf-8')
+
+    def send(self, chunk_type, payload):
+        self.request.sendall(struct.pack('>Ic', len(payload), chunk_type) +
+                payload)
+
+    def handle(self):
+        command = None
+        args = []
+        while command is None:
+            chunk_type, payload = self.recv_chunk()
+            if chunk_type == b'A':
+                args.append(payload)
+            elif chunk_type == b'C':
+                command = payload
+
+        self.server.calls.append((command, args))
+        if self.server.hung or command == 'hang':
+            time.sleep(3)
+            return
+
+        if command == 'echo':
+            self.send(b'S', b'')
+            assert self.recv_chunk()[0] == b'.'
+            out = ' '.join(args).encode('utf-8')
+            self.send(b'1', out[:3])
+            self.send(b'1', out[3:] + b'\r\n')
+        elif command == 'fail':
+            self.send(b'2', b'boom')
+            self.send(b'1', b'partial')
+            self.send(b'X', b'3')
+            return
+        elif command == 'sleep':
+            time.sleep(float(args[0]))
+            self.send(b'1', str(self.server.server_address[1]).encode())
+        elif not command.startswith('ng-'):
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.active,
+                        self.server.max_active)
+            time.sleep(self.server.delay)
+            with self.server.lock:
+                self.server.active -= 1
+
+            urls = [a for a in args if a.startswith('http')]
+            if any('broken' in u for u in urls):
+                self.send(b'X', b'1')
+                return
+
+            articles = [{'url': u, 'article': 'about ' + u} for u in urls]
+            self.send(b'1', json.dumps(articles).encode('utf-8'))
+
+        self.send(b'X', b'0')
+        return
+
+class FakeNailgunServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port),
+                FakeNailgunHandler)
+        self.calls = []
+        self.hung = False
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+def closed_port():
+    """
+    returns a local port nothing listens on.
+    """
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+nailgun_servers = []
+
+def test_nailgun_setup():
+
+    nailgun_servers.append(FakeNailgunServer())
+    return
+
+def test_nailgun_teardown():
+
+    while nailgun_servers:
+        nailgun_servers.pop().close()
+    return
+
+@with_setup(test_nailgun_setup, test_nailgun_teardown)
+def test_nailgun_call():
+    """
+    the native nailgun client must return the stdout of the command, raise
+    on its exit status and on a server that is gone or silent.
+    """
+
+    port = nailgun_servers[0].port
+
+    assert nailgun_call('echo', ['-u', 'publish', 'Montréal'], '127.0.0.1',
+            port) == '-u publish Montréal\n'
+    assert nailgun_servers[0].calls == [('echo', ['-u', 'publish', 'Montréal'])]
+
+    try:
+        nailgun_call('fail', [], '127.0.0.1', port)
+        assert False
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 3
+        assert e.output == 'partial'
+
+    try:
+        nailgun_call('echo', [], '127.0.0.1', closed_port())
+        assert False
+    except ConnectionRefusedError:
+        pass
+
+    start = time.time()
+    try:
+        nailgun_call('hang', [], '127.0.0.1', port, timeout = 0.5)
+        assert False
+    except socket.timeout:
+        assert time.time() - start < 2
+
+    return
+
+@with_setup(test_nailgun_setup, test_nailgun_teardown)
+def test_nailgun_server():
+    """
+    a running server must be kept and only get the jars it is missing, and
+    a server that is gone or hung is not healthy.
+    """
+
+    fake = nailgun_servers[0]
+    server = NailgunServer('/nonexistent/nailgun.jar', '127.0.0.1', fake.port,
+            health_timeout = 0.5)
+
+    assert server.healthy()
+    assert not server.ensure(['a.jar'])
+    assert not server.ensure(['a.jar', 'b.jar'])
+    assert not server.ensure(['b.jar'])
+    assert server.process is None
+    assert [c for c in fake.calls if c[0] == 'ng-cp'] == \
+            [('ng-cp', ['a.jar']), ('ng-cp', ['b.jar'])]
+
+    fake.hung = True
+    start = time.time()
+    assert not server.healthy()
+    assert time.time() - start < 2
+
+    gone = NailgunServer('/nonexistent/nailgun.jar', '127.0.0.1', closed_port(),
+            health_timeout = 0.5)
+    assert not gone.healthy()
+    return
+
+def test_nailgun_pool_setup():
+
+    # the servers of a pool listen on consecutive ports.
+    while not nailgun_servers:
+        port = random.randint(20000, 60000)
+        try:
+            nailgun_servers.append(FakeNailgunServer(port))
+            nailgun_servers.append(FakeNailgunServer(port + 1))
+        except OSError:
+            test_nailgun_teardown()
+
+    return
+
+@with_setup(test_nailgun_pool_setup, test_nailgun_teardown)
+def test_nailgun_pool():
+    """
+    the calls must be spread over the servers, and a call refused by a
+    server must be retried on another one while the failed server is left
+    out.
+    """
+
+    port = nailgun_servers[0].port
+    pool = NailgunPool('/nonexistent/nailgun.jar', 2, '127.0.0.1', port,
+            timeout = 1)
+    assert not pool.ensure()
+
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        served = list(executor.map(lambda i: pool.call('sleep', ['0.3']),
+            range(4)))
+    assert collections.Counter(served) == {str(port): 2, str(port + 1): 2}
+
+    # a failed command is not the server's fault.
+    try:
+        pool.call('fail', [])
+        assert False
+    except subprocess.CalledProcessError:
+        pass
+    assert pool.up == [True, True]
+
+    nailgun_servers[0].close()
+    assert pool.call('echo', ['Montréal']) == 'Montréal\n'
+    assert pool.up == [False, True]
+    assert pool.call('echo', ['Lisbon']) == 'Lisbon\n'
+    return
+
+def description_guide(path, urls):
+    """
+    write a guide with a poi described by each of the urls.
+    """
+
+    pois = [{'name': {'name': 'poi {}'.format(i)},
+             'descriptions': {'en': {'source': {'url': u}, 'text': None}}}
+            for i, u in enumerate(urls)]
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as guide:
+        json.dump({'Id': 1, 'Cities': [{'name': 'Montreal', 'pois': pois}]},
+                guide)
+
+    return
+
+def description_texts(path):
+    """
+    returns the description texts of the pois of the guide by source url.
+    """
+
+    with open(path) as guide:
+        pois = json.load(guide)['Cities'][0]['pois']
+
+    return {p['descriptions']['en']['source']['url']:
+            p['descriptions']['en']['text'] for p in pois}
+
+def test_description_setup():
+
+    test_nailgun_setup()
+    os.environ['NAILGUN_PORT'] = str(nailgun_servers[0].port)
+    return
+
+def test_description_teardown():
+
+    nailgunstop()
+    del os.environ['NAILGUN_PORT']
+    test_nailgun_teardown()
+    shutil.rmtree('/tmp/test_description', ignore_errors = True)
+    return
+
+@with_setup(test_description_setup, test_description_teardown)
+def test_description_batches():
+    """
+    the description urls of a guide must be sent to the generator once
+    each, batch_size at a time, and their articles inserted.
+    """
+
+    guide = '/tmp/test_description/city-1/result.json'
+    urls = ['http://en.wikipedia.org/wiki/{}'.format(i) for i in range(5)]
+    description_guide(guide, urls + [urls[0], 'http://facebook.com/montreal'])
+
+    assert not description_publish([guide], 'publish', 'wikison',
+            '/nonexistent/nailgun.jar', 'wikison.jar', batch_size = 2)
+
+    texts = description_texts(guide)
+    assert texts['http://facebook.com/montreal'] is None
+    assert all(texts[u] == 'about ' + u for u in urls)
+
+    batches = [[a for a in args if a.startswith('http')]
+               for command, args in nailgun_servers[0].calls
+               if command == 'wikison']
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert sorted(sum(batches, [])) == urls
+    return
+
+@with_setup(test_description_setup, test_description_teardown)
+def test_description_concurrency():
+    """
+    up to concurrency generator calls must be in flight across guides, and
+    a failed call must only be an error for its guide.
+    """
+
+    nailgun_servers[0].delay = 0.2
+    guides = ['/tmp/test_description/city-{}/result.json'.format(i)
+              for i in range(3)]
+    for i, g in enumerate(guides):
+        description_guide(g, ['http://en.wikipedia.org/wiki/{}-{}'.format(i, j)
+                              for j in range(2)])
+    description_guide(guides[2], ['http://en.wikipedia.org/wiki/2-0',
+                                  'http://en.wikipedia.org/wiki/broken'])
+
+    assert description_publish(guides, 'publish', 'wikison',
+            '/nonexistent/nailgun.jar', 'wikison.jar', batch_size = 1,
+            concurrency = 3)
+
+    assert nailgun_servers[0].max_active == 3
+    for g in guides[:2]:
+        assert all(t == 'about ' + u for u, t in description_texts(g).items())
+
+    texts = description_texts(guides[2])
+    assert texts['http://en.wikipedia.org/wiki/2-0'] == \
+            'about http://en.wikipedia.org/wiki/2-0'
+    assert texts['http://en.wikipedia.org/wiki/broken'] is None
+    return
+
+class FakeCursor(object):
+    """
+    cursor of a FakeConnection, answering the statements it prepared with
+    the rows given by the answer function of the connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, statement, params=None):
+        self.connection.statements.append((statement, params))
+        if statement.startswith('execute '):
+            name = statement.split()[1]
+            assert name in self.connection.prepared
+            self.rows = self.connection.answer(name, params)
+        elif statement.startswith('prepare '):
+            self.connection.prepared.add(statement.split()[1])
+            self.rows = []
+
+class FakeConnection(object):
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.autocommit = False
+        self.prepared = set()
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakePool(object):
+    """
+    a pool of a single FakeConnection, in place of a psycopg2 pool.
+    """
+
+    def __init__(self, answer):
+        self.connection = FakeConnection(answer)
+        self.closed = False
+
+    def getconn(self):
+        return self.connection
+
+    def putconn(self, connection):
+        pass
+
+    def closeall(self):
+        self.closed = True
+
+def db_guide(path, content):
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as guide:
+        json.dump(content, guide)
+    return
+
+def load_test_guide(path):
+
+    with open(path) as guide:
+        return json.load(guide)
+
+def test_db_setup():
+
+    close_process_connections()
+    db_timings.clear()
+    return
+
+def test_db_teardown():
+
+    close_process_connections()
+    db_timings.clear()
+    shutil.rmtree('/tmp/test_db', ignore_errors = True)
+    return
+
+@with_setup(test_db_setup, test_db_teardown)
+def test_alternate_names():
+    """
+    the alternate names of the cities must be fetched chunk_size guides per
+    query and inserted in every guide, even the ones without any.
+    """
+
+    names = {1: [('fr', 'Montréal')], 2: [('pt', 'Lisboa'), ('fr', 'Lisbonne')]}
+
+    def answer(name, params):
+        assert name == 'alternate_names'
+        return [(i, lang, n) for i in params[0] for lang, n in names.get(i, [])]
+
+    pool = db_pools[('/tmp/test_db/db.json', 'alternate-names')] = \
+            FakePool(answer)
+
+    guides = ['/tmp/test_db/city-{}/result.json'.format(i) for i in range(1, 4)]
+    for g in guides:
+        db_guide(g, {'Cities': [{'name': 'city', 'pois': []}]})
+
+    assert not city_name_translation('/tmp/test_db/db.json', guides, 2)
+
+    executed = [p for s, p in pool.connection.statements
+                if s.startswith('execute ')]
+    assert executed == [[[1, 2]], [[3]]]
+
+    assert load_test_guide(guides[0])['Cities'][0]['alternate-names'] == \
+            [{'isolanguage': 'fr', 'alternate-name': 'Montréal'}]
+    assert len(load_test_guide(guides[1])['Cities'][0]['alternate-names']) == 2
+    assert load_test_guide(guides[2])['Cities'][0]['alternate-names'] == []
+    return
+
+@with_setup(test_db_setup, test_db_teardown)
+def test_iata_codes():
+    """
+    the iata codes must be fetched chunk_size guides per query and set on
+    every guide with a bounding box, a guide without one is an error.
+    """
+
+    airports = {45.7: 'YUL', 38.9: 'LIS'}
+
+    def answer(name, params):
+        assert name == 'iata_codes'
+        return [(i, airports.get(float(top)), 'airport')
+                if airports.get(float(top)) else (i, None, None)
+                for i, top in zip(params[0], params[1])]
+
+    pool = db_pools[('/tmp/test_db/db.json', 'iata-codes')] = FakePool(answer)
+
+    guides = ['/tmp/test_db/city-{}/result.json'.format(i) for i in range(1, 5)]
+    boxes = [[45.7, -73.9, 45.4, -73.4], [38.9, -9.3, 38.6, -9.0],
+             [10.0, 10.0, 9.0, 11.0]]
+    for g, box in zip(guides, boxes):
+        db_guide(g, {'Cities': [{'name': 'city', 'bounding_box': box}]})
+    db_guide(guides[3], {'Cities': [{'name': 'city'}]})
+
+    assert iata_codes('/tmp/test_db/db.json', guides, 2)
+
+    executed = [p for s, p in pool.connection.statements
+                if s.startswith('execute ')]
+    assert [p[0] for p in executed] == [[0, 1], [0]]
+
+    assert load_test_guide(guides[0])['Cities'][0]['iata'] == 'YUL'
+    assert load_test_guide(guides[1])['Cities'][0]['iata'] == 'LIS'
+    assert load_test_guide(guides[2])['Cities'][0]['iata'] is None
+    assert not 'iata' in load_test_guide(guides[3])['Cities'][0]
+    return
+
+@with_setup(test_db_setup, test_db_teardown)
+def test_db_execute():
+    """
+    a statement must be prepared once per connection, the pool connections
+    must be closed before forking, and the timings of the workers add up.
+    """
+
+    conf = '/tmp/test_db/db.json'
+    first = db_pools[(conf, 'iata-codes')] = FakePool(lambda name, p: [p])
+
+    for i in range(3):
+        with db_cursor(conf, 'iata-codes') as cur:
+            db_execute(cur, 'lookup', 'select $1::int', [i])
+            assert list(cur) == [[i]]
+
+    statements = [s for s, p in first.connection.statements]
+    assert statements == ['prepare lookup as select $1::int'] + \
+            ['execute lookup (%s)'] * 3
+    assert first.connection.autocommit
+
+    close_process_connections()
+    assert first.closed
+
+    second = db_pools[(conf, 'iata-codes')] = FakePool(lambda name, p: [p])
+    with db_cursor(conf, 'iata-codes') as cur:
+        db_execute(cur, 'lookup', 'select $1::int', [3])
+    assert second.connection.statements[0][0] == \
+            'prepare lookup as select $1::int'
+
+    assert db_timings['lookup'][0] == 4
+    merge_db_timings({'lookup': [2, 1.5], 'iata_codes': [1, 0.5]})
+    assert db_timings['lookup'][0] == 6
+    assert db_timings['lookup'][1] >= 1.5
+    assert db_timings['iata_codes'] == [1, 0.5]
+    return
+
+def test_jobs_setup():
+
+    for mode in ['serial', 'jobs']:
+        for i in range(1, 6):
+            pois = [{'name': {'name': 'poi {}'.format(j)},
+                     'homepage': {'homepage': 'http://www.facebook.com/{}'.format(j)
+                                  if j % 2 else 'http://www.poi.com/'}}
+                    for j in range(4)]
+            content = {'Id': i, 'Cities': [{'name': 'city', 'pois': pois}]}
+            if i == 3:
+                content = {'Id': i, 'Cities': [{'name': 'city'}]}
+            db_guide('/tmp/test_jobs/{}/city-{}/result.json'.format(mode, i),
+                    content)
+
+    metrics.clear()
+    metrics.stage = 'test-jobs'
+    return
+
+def test_jobs_teardown():
+
+    metrics.clear()
+    metrics.stage = None
+    shutil.rmtree('/tmp/test_jobs', ignore_errors = True)
+    return
+
+@with_setup(test_jobs_setup, test_jobs_teardown)
+def test_jobs():
+    """
+    a stage run on worker processes must give the same guides and errors as
+    a serial one, and hand back the metrics of the workers.
+    """
+
+    serial = list_guide('/tmp/test_jobs/serial', 'result.json')
+    jobs = list_guide('/tmp/test_jobs/jobs', 'result.json')
+
+    assert remove_homepage_from_domains(serial, ['facebook'])
+    metrics.clear()
+    assert remove_homepage_from_domains(jobs, ['facebook'], jobs = 2)
+
+    for s, j in zip(sorted(serial), sorted(jobs)):
+        assert load_test_guide(s) == load_test_guide(j)
+
+    pois = load_test_guide('/tmp/test_jobs/jobs/city-1/result.json')\
+            ['Cities'][0]['pois']
+    assert [p['homepage']['homepage'] for p in pois] == \
+            ['http://www.poi.com/', None, 'http://www.poi.com/', None]
+
+    assert 'publish_guide_duration_seconds_count{stage="test-jobs"} 5' in \
+            metrics.text()
+    return
+
+def test_pipeline_setup():
+
+    wiki = {'en': {'source': {'url': 'http://en.wikipedia.org/wiki/Louvre'}}}
+    pois = [{'name': {'name': 'Louvre'}, 'category': 'attractions',
+             'subcategory': 'museum', 'descriptions': wiki,
+             'homepage': {'homepage': 'http://www.facebook.com/louvre'}},
+            {'name': {'name': 'Tour'}, 'category': 'attractions',
+             'subcategory': 'monument', 'descriptions': {},
+             'homepage': {'homepage': 'http://www.tour.fr/'}},
+            {'name': {'name': 'Café'}, 'category': 'restaurants',
+             'subcategory': 'cafe', 'descriptions': {},
+             'homepage': {'homepage': 'http://www.yelp.com/cafe'}}]
+
+    for mode in ['stages', 'pipeline']:
+        db_guide('/tmp/test_pipeline/{}/city-1/result.json'.format(mode),
+                {'Id': 1, 'Subjects': {},
+                 'Cities': [{'name': 'Paris', 'pois': pois}]})
+
+    return
+
+def test_pipeline_teardown():
+
+    shutil.rmtree('/tmp/test_pipeline', ignore_errors = True)
+    return
+
+@with_setup(test_pipeline_setup, test_pipeline_teardown)
+def test_pipeline():
+    """
+    the single pass pipeline must give the same guide as the stages run one
+    after the other, and not rewrite a guide it does not change.
+    """
+
+    stages = ['attraction-remove', 'homepage-remove', 'categories']
+    guide = '/tmp/test_pipeline/stages/city-1/result.json'
+    assert not filter_poi([guide], must_remove_attraction)
+    assert not remove_homepage_from_domains([guide], ['facebook', 'yelp'])
+    assert not categories([guide])
+
+    pipelined = '/tmp/test_pipeline/pipeline/city-1/result.json'
+    assert not pipeline_publish([pipelined], stages, ['facebook', 'yelp'],
+            '/tmp/test_pipeline/db.json')
+
+    content = load_test_guide(pipelined)
+    assert content == load_test_guide(guide)
+    assert [p['name']['name'] for p in content['Cities'][0]['pois']] == \
+            ['Louvre', 'Café']
+    assert content['Subjects'] == {'attractions': ['museum'],
+                                   'restaurants': ['cafe']}
+
+    mtime = os.stat(pipelined).st_mtime_ns
+    time.sleep(0.01)
+    assert not pipeline_publish([pipelined], stages, ['facebook', 'yelp'],
+            '/tmp/test_pipeline/db.json')
+    assert os.stat(pipelined).st_mtime_ns == mtime
+    return